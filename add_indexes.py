@@ -0,0 +1,97 @@
+"""
+Adds the indexes declared in `models.py` to existing databases and runs ANALYZE.
+
+Every query of `queries.py` is timed before and after, to show what the indexes buy.
+Queries over tables that a database does not have are skipped.
+
+Example usage:
+
+```bash
+python add_indexes.py data/sst-23-24-cleaned.db data/acf-23-24.db
+```
+"""
+
+import argparse
+import sqlite3
+import time
+from typing import Dict, Optional
+
+from tabulate import tabulate
+
+import queries
+from models import create_missing_indexes, create_transactional_engine
+from utils.sqlite_profiles import WRITE_PROFILES, reset_journal_mode
+
+QUERIES = {
+    name: query for name, query in vars(queries).items() if name.endswith("_QUERY")
+}
+
+
+def time_queries(db_path: str, repeat: int = 3) -> Dict[str, Optional[float]]:
+    """Best time of `repeat` runs of each query, None if it cannot run on the db."""
+    timings = {}
+    con = sqlite3.connect(db_path)
+    for name, query in QUERIES.items():
+        try:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                con.execute(query).fetchall()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+        except sqlite3.OperationalError:
+            timings[name] = None
+    con.close()
+    return timings
+
+
+def add_indexes(db_path: str, repeat: int = 3, profile: str = "default"):
+    before = time_queries(db_path, repeat)
+
+    engine = create_transactional_engine(db_path, profile)
+    with engine.begin() as conn:
+        created, skipped = create_missing_indexes(conn)
+        conn.exec_driver_sql("ANALYZE")
+    engine.dispose()
+    reset_journal_mode(db_path, profile)
+    print(f"Created {len(created)} indexes: {', '.join(created)}")
+    if skipped:
+        print(
+            f"Skipped {len(skipped)} indexes on tables or columns missing from the "
+            f"db, run migrate.py first: {', '.join(skipped)}"
+        )
+
+    after = time_queries(db_path, repeat)
+    rows = [
+        [name, before[name], after[name], before[name] / after[name]]
+        for name in QUERIES
+        if before[name] is not None and after[name] is not None
+    ]
+    print(
+        tabulate(
+            rows,
+            headers=["query", "before (s)", "after (s)", "speedup"],
+            tablefmt="psql",
+            floatfmt=".4f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add indexes to databases.")
+    parser.add_argument("db_paths", nargs="+", help="Paths to the databases")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of timed runs of each query"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=WRITE_PROFILES,
+        default="default",
+        help="SQLite connection profile, see utils/sqlite_profiles.py",
+    )
+    args = parser.parse_args()
+
+    for db_path in args.db_paths:
+        print(f"\nAdding indexes to {db_path}")
+        add_indexes(db_path, args.repeat, args.profile)
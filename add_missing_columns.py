@@ -1,85 +1,78 @@
 """
 Adds a `question_set_edition_id` column to the `question` table.
 
-This column is necessary for ACF data consistency.
+This column is necessary for ACF data consistency. `merge_db.py` derives it while merging
+sources that lack it (see `models.DERIVED_COLUMNS`), so this script is only needed to
+fix a database in place. The column is added and populated by the migrations of
+`migrate.py`, then validated.
 
 Example usage:
 
 ```bash
 python add_missing_columns.py data/sst-23-24-cleaned.db data/nats24.db
 ```
+
+The databases are processed concurrently.
 """
 
+import os
 import sys
-
-from sqlalchemy import create_engine, inspect, text
-from sqlalchemy.orm import sessionmaker
-
-from models import PacketQuestion, Question
-
-
-def column_exists(engine, table_name, column_name):
-    inspector = inspect(engine)
-    columns = [col["name"] for col in inspector.get_columns(table_name)]
-    return column_name in columns
-
-
-def add_column(engine, table_name, column_name, column_type):
-    if not column_exists(engine, table_name, column_name):
-        with engine.connect() as conn:
-            conn.execute(
-                text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
-            )
-            conn.commit()
-    else:
-        print(f"Column {column_name} already exists in table {table_name}")
-
-
-def determine_question_set_edition_id(question: Question) -> int:
-    qset_edition_ids = set()
-    for pq in question.packet_questions:
-        qset_edition_ids.add(pq.packet.question_set_edition_id)
-    assert len(qset_edition_ids) == 1
-    return qset_edition_ids.pop()
-
-
-def populate_question_set_edition_id(session):
-    questions = session.query(Question).all()
-    for question in questions:
-        question_set_edition_id = determine_question_set_edition_id(question)
-        if question.question_set_edition_id is None:
-            question.question_set_edition_id = question_set_edition_id
-        elif question.question_set_edition_id != question_set_edition_id:
-            print(
-                f"Question {question.id} has question_set_edition_id {question.question_set_edition_id} but should be {question_set_edition_id}"
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from sqlalchemy import create_engine, text
+
+from migrate import upgrade
+
+
+def validate_question_set_edition_constraint(conn) -> List[int]:
+    """
+    Find the packet questions whose question is not in the same question set edition as
+    their packet, with a single anti-join. NULL editions match each other, as in
+    `models.check_packet_questions`.
+
+    :return: Ids of the violating packet questions
+    """
+    return (
+        conn.execute(
+            text(
+                "SELECT pq.id FROM packet_question pq WHERE NOT EXISTS ("
+                "SELECT 1 FROM question q JOIN packet p "
+                "ON p.question_set_edition_id IS q.question_set_edition_id "
+                "WHERE q.id = pq.question_id AND p.id = pq.packet_id) "
+                "ORDER BY pq.id"
             )
-            assert False
-    session.commit()
-
-
-def validate_question_set_edition_constraint(session):
-    packet_questions = session.query(PacketQuestion).all()
-    for pq in packet_questions:
-        assert pq.question.question_set_edition_id == pq.packet.question_set_edition_id
+        )
+        .scalars()
+        .all()
+    )
 
 
 def add_question_set_edition_id_to_question(db_path: str):
-    engine = create_engine(db_path)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    print("Adding question_set_edition_id column...")
-    add_column(engine, "question", "question_set_edition_id", "INTEGER")
-
-    print("Populating question_set_edition_id...")
-    populate_question_set_edition_id(session)
+    print(f"{db_path}: Adding and populating question_set_edition_id...")
+    upgrade(db_path)
 
-    print("Validating question_set_edition_id constraint...")
-    validate_question_set_edition_constraint(session)
+    print(f"{db_path}: Validating question_set_edition_id constraint...")
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.connect() as conn:
+        violations = validate_question_set_edition_constraint(conn)
+    assert not violations, (
+        f"{db_path}: Packet questions in a different question set edition than their "
+        f"question: {violations}"
+    )
+    engine.dispose()
 
 
 if __name__ == "__main__":
     db_paths = sys.argv[1:]
-    for db_path in db_paths:
-        print(f"\nAdding question_set_edition_id to {db_path}")
-        add_question_set_edition_id_to_question(f"sqlite:///{db_path}")
+    if not db_paths:
+        print(f"Usage: python {sys.argv[0]} <db_path> [<db_path> ...]")
+        sys.exit(0)
+    # The work is done by SQLite, which releases the GIL, so threads run it in parallel
+    with ThreadPoolExecutor(max_workers=min(len(db_paths), os.cpu_count())) as pool:
+        futures = [
+            pool.submit(add_question_set_edition_id_to_question, db_path)
+            for db_path in db_paths
+        ]
+        for future in futures:
+            future.result()
@@ -0,0 +1,211 @@
+"""
+Exports the buzzes of a database as a "buzz cube": one memory-mapped NumPy file per
+column, with CSR indexes by tossup and by player, so that analysis scripts can open a
+season without SQL or pandas.
+
+Layout of a cube directory:
+- `<column>.npy`: the `id`, `player_id`, `tossup_id`, `game_id` (int32),
+  `buzz_position` and `value` (int16) columns of the buzz table. NULLs are stored as
+  the minimum value of the dtype (`null_value`). Rows are sorted by tossup, buzz
+  position and id.
+- `tossup_ids.npy`, `tossup_offsets.npy`: the distinct tossup ids, and the offsets of
+  their rows, i.e. the rows of `tossup_ids[i]` are `tossup_offsets[i]` to
+  `tossup_offsets[i + 1]`.
+- `player_ids.npy`, `player_offsets.npy`, `player_rows.npy`: the same by player, over
+  `player_rows`, the positions of the rows sorted by player, then in cube (tossup)
+  order.
+- `meta.json`: the number of rows, the source database, and {id: slug} dictionaries of
+  the players, teams, tournaments and tossups (their question slugs), along with the
+  team of each player and the tournament of each game.
+
+Example usage:
+
+```bash
+python buzz_cube.py data/acf-23-24.db data/acf-23-24.cube
+```
+
+```python
+cube = BuzzCube("data/acf-23-24.cube")
+positions = cube.by_tossup(42)["buzz_position"]  # view of the memory-mapped file
+```
+"""
+
+import argparse
+import json
+import os
+from datetime import datetime
+from typing import Dict, Union
+
+import numpy as np
+from loguru import logger
+
+from utils.sqlite_profiles import PROFILES, connect
+
+# Columns of the cube and their dtypes
+COLUMNS = {
+    "id": np.int32,
+    "player_id": np.int32,
+    "tossup_id": np.int32,
+    "game_id": np.int32,
+    "buzz_position": np.int16,
+    "value": np.int16,
+}
+
+# Number of rows read from the database at a time
+FETCH_SIZE = 100000
+
+SLUG_QUERIES = {
+    "player": "SELECT id, slug FROM player",
+    "team": "SELECT id, slug FROM team",
+    "tournament": "SELECT id, slug FROM tournament",
+    "tossup": (
+        "SELECT tu.id, q.slug FROM tossup tu JOIN question q ON q.id = tu.question_id"
+    ),
+    "player_team": "SELECT id, team_id FROM player",
+    "game_tournament": (
+        "SELECT g.id, r.tournament_id FROM game g JOIN round r ON r.id = g.round_id"
+    ),
+}
+
+
+def null_value(dtype) -> int:
+    """Value of NULL in a column of the cube, the minimum value of its dtype."""
+    return int(np.iinfo(dtype).min)
+
+
+def csr_index(keys: np.ndarray):
+    """Distinct values and offsets of the runs of equal values of sorted `keys`."""
+    if len(keys) == 0:
+        return keys, np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.diff(keys)) + 1
+    offsets = np.concatenate([[0], starts, [len(keys)]]).astype(np.int64)
+    return keys[offsets[:-1]], offsets
+
+
+def read_buzzes(con) -> Dict[str, np.ndarray]:
+    """The buzz table as one array per column of `COLUMNS`, in cube order."""
+    n_rows = con.execute("SELECT COUNT(*) FROM buzz").fetchone()[0]
+    columns = {name: np.empty(n_rows, dtype=dtype) for name, dtype in COLUMNS.items()}
+    select = ", ".join(
+        f"COALESCE({name}, {null_value(dtype)})" for name, dtype in COLUMNS.items()
+    )
+    cursor = con.execute(
+        f"SELECT {select} FROM buzz ORDER BY tossup_id, buzz_position, id"
+    )
+    start = 0
+    while rows := cursor.fetchmany(FETCH_SIZE):
+        values = np.array(rows, dtype=np.int64)
+        for i, (name, dtype) in enumerate(COLUMNS.items()):
+            info = np.iinfo(dtype)
+            if values[:, i].min() < info.min or values[:, i].max() > info.max:
+                raise ValueError(f"buzz.{name} does not fit in {np.dtype(dtype)}")
+            columns[name][start : start + len(rows)] = values[:, i]
+        start += len(rows)
+    return columns
+
+
+def export_buzz_cube(db_path: str, cube_path: str, profile: str = "analytics") -> None:
+    """Write the buzz cube of a database to the directory `cube_path`."""
+    con = connect(db_path, profile)
+    columns = read_buzzes(con)
+    meta = {
+        "source": os.path.abspath(db_path),
+        "created_at": datetime.now().isoformat(),
+        "n_rows": len(columns["id"]),
+    }
+    for name, query in SLUG_QUERIES.items():
+        meta[name] = {str(id): value for id, value in con.execute(query)}
+    con.close()
+
+    os.makedirs(cube_path, exist_ok=True)
+    arrays = dict(columns)
+    arrays["tossup_ids"], arrays["tossup_offsets"] = csr_index(columns["tossup_id"])
+    # Stable sort, so the rows of each player stay in tossup order
+    player_rows = np.argsort(columns["player_id"], kind="stable").astype(np.int32)
+    arrays["player_rows"] = player_rows
+    arrays["player_ids"], arrays["player_offsets"] = csr_index(
+        columns["player_id"][player_rows]
+    )
+    for name, array in arrays.items():
+        np.save(os.path.join(cube_path, f"{name}.npy"), array)
+    # Written last, so a cube with a meta.json is complete
+    with open(os.path.join(cube_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    logger.info(f"Exported {meta['n_rows']} buzzes of {db_path} to {cube_path}")
+
+
+class BuzzCube:
+    """
+    Buzz cube written by `export_buzz_cube`. Its files are memory-mapped, so opening
+    it reads nothing but `meta.json`.
+    """
+
+    def __init__(self, cube_path: str):
+        self.path = cube_path
+        with open(os.path.join(cube_path, "meta.json")) as f:
+            meta = json.load(f)
+        self.meta = meta
+        self.slugs = {
+            name: {int(id): value for id, value in meta[name].items()}
+            for name in SLUG_QUERIES
+        }
+        self.arrays = {}
+
+    def __len__(self) -> int:
+        return self.meta["n_rows"]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """A column or index array of the cube, memory-mapped read-only."""
+        if name not in self.arrays:
+            path = os.path.join(self.path, f"{name}.npy")
+            self.arrays[name] = np.load(path, mmap_mode="r")
+        return self.arrays[name]
+
+    @staticmethod
+    def _find(ids: np.ndarray, id: int) -> int:
+        """Position of an id in sorted `ids`, or -1."""
+        i = int(np.searchsorted(ids, id))
+        return i if i < len(ids) and ids[i] == id else -1
+
+    def tossup_rows(self, tossup_id: int) -> slice:
+        """Rows of the buzzes on a tossup."""
+        i = self._find(self["tossup_ids"], tossup_id)
+        if i < 0:
+            return slice(0, 0)
+        offsets = self["tossup_offsets"]
+        return slice(int(offsets[i]), int(offsets[i + 1]))
+
+    def player_rows(self, player_id: int) -> np.ndarray:
+        """Rows of the buzzes of a player, in tossup order."""
+        i = self._find(self["player_ids"], player_id)
+        if i < 0:
+            return self["player_rows"][:0]
+        offsets = self["player_offsets"]
+        return self["player_rows"][offsets[i] : offsets[i + 1]]
+
+    def rows(self, rows: Union[slice, np.ndarray]) -> Dict[str, np.ndarray]:
+        """The columns of the cube at some rows; views if `rows` is a slice."""
+        return {name: self[name][rows] for name in COLUMNS}
+
+    def by_tossup(self, tossup_id: int) -> Dict[str, np.ndarray]:
+        """The columns of the buzzes on a tossup, as views of the cube."""
+        return self.rows(self.tossup_rows(tossup_id))
+
+    def by_player(self, player_id: int) -> Dict[str, np.ndarray]:
+        """The columns of the buzzes of a player, gathered from the cube."""
+        return self.rows(self.player_rows(player_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the buzz cube of a database.")
+    parser.add_argument("db_path", help="Path to the database")
+    parser.add_argument("cube_path", help="Directory of the cube")
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default="analytics",
+        help="SQLite connection profile, see utils/sqlite_profiles.py",
+    )
+    args = parser.parse_args()
+
+    export_buzz_cube(args.db_path, args.cube_path, args.profile)
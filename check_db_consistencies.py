@@ -17,32 +17,40 @@ from collections import defaultdict
 from datetime import timedelta
 
 import models
-from models import create_session
+from models import create_session, loader_options
 
 db_path = sys.argv[1]
 
 print(f"Checking database at {db_path}")
-session = create_session(db_path)
+session = create_session(db_path, profile="analytics")
 
 
 # Check if a round always points to the same question_set_edition
-for round in session.query(models.Round).all():
+for round in (
+    session.query(models.Round).options(*loader_options("round_editions")).all()
+):
     assert (
         round.packet.question_set_edition_id == round.tournament.question_set_edition_id
     )
 
 # Check if a packet question always points to the same question_set_edition
-for pq in session.query(models.PacketQuestion).all():
+for pq in (
+    session.query(models.PacketQuestion)
+    .options(*loader_options("packet_question_editions"))
+    .all()
+):
     assert pq.question.question_set_edition_id == pq.packet.question_set_edition_id
 
 
 # Check if a game from a tournament only has participants from that tournament
-for game in session.query(models.Game).all():
+for game in session.query(models.Game).options(*loader_options("game_teams")).all():
     assert game.round.tournament_id == game.team_one.tournament_id
     assert game.round.tournament_id == game.team_two.tournament_id
 
 # Check if a buzz is associated with the same question set edition as the game and team's tournament
-for buzz in session.query(models.Buzz).all():
+for buzz in (
+    session.query(models.Buzz).options(*loader_options("buzz_tournaments")).all()
+):
     assert (
         buzz.tossup.question.question_set_edition_id
         == buzz.game.round.tournament.question_set_edition_id
@@ -56,7 +64,11 @@ for buzz in session.query(models.Buzz).all():
 
 # Check if a tossup is tournaments around the same date
 ALLOWED_GAP = timedelta(days=7)
-for tossup in session.query(models.Tossup).all():
+for tossup in (
+    session.query(models.Tossup)
+    .options(*loader_options("tossup_buzz_tournaments"))
+    .all()
+):
     tourney_dates = set()
     for buzz in tossup.buzzes:
         tourney_dates.add(buzz.game.round.tournament.end_date)
@@ -69,16 +81,26 @@ for tossup in session.query(models.Tossup).all():
 
 
 # Check if tournament levels associated with a question set are the same
-for qset in session.query(models.QuestionSetEdition).all():
+for qset in (
+    session.query(models.QuestionSetEdition)
+    .options(*loader_options("question_set_edition_tournaments"))
+    .all()
+):
     levels = {t.level for t in qset.tournaments}
     assert len(levels) == 1
 
 
-for qset in session.query(models.QuestionSetEdition).all():
+for qset in (
+    session.query(models.QuestionSetEdition)
+    .options(*loader_options("question_set_edition_tournaments"))
+    .all()
+):
     print(qset.full_slug, qset.question_set.difficulty.split()[0])
 
 # Check for duplicate questions
-questions = session.query(models.Question).all()
+questions = (
+    session.query(models.Question).options(*loader_options("question_tossups")).all()
+)
 
 
 def unique_key(q: models.Question):
@@ -6,10 +6,11 @@ from sklearn.cluster import SpectralBiclustering
 from sklearn.metrics import consensus_score
 
 import models
+from utils.query_cache import QueryCache
 from utils.sqlite_client import DBClient
 
 # %%
-db = DBClient("./data/acf-23-24.db")
+db = DBClient("./data/acf-23-24.db", profile="analytics", cache=QueryCache())
 full_buzz_df = db.get_buzzpoints_info()
 tossup_df = db.get_tossups_info()
 
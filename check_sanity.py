@@ -11,7 +11,7 @@ from utils import acf_sanitization
 acf_sanitization = importlib.reload(acf_sanitization)
 
 
-session = models.create_session("data/acf-23-24.db")
+session = models.create_session("data/acf-23-24.db", profile="analytics")
 tossups = session.query(models.Tossup).all()
 
 
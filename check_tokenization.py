@@ -10,7 +10,7 @@ from nltk.tokenize import PunktSentenceTokenizer
 from rich import print as rprint
 
 import models
-from structs import create_tossup_entry
+from structs import create_tossup_entry, query_tossups
 from utils import acf_sanitization, qb_tokenization
 
 qb_tokenization = importlib.reload(qb_tokenization)
@@ -18,8 +18,8 @@ acf_sanitization = importlib.reload(acf_sanitization)
 
 
 # %%
-session = models.create_session("data/acf-23-24.db")
-tossups = session.query(models.Tossup).all()
+session = models.create_session("data/acf-23-24.db", profile="analytics")
+tossups = query_tossups(session)
 tossups_by_id = {t.id: t for t in tossups}
 
 punkt_sent_tokenizer = PunktSentenceTokenizer()
@@ -443,7 +443,7 @@ for c in sorted(all_bf_clues, key=len, reverse=True)[:10]:
 
 # %%
 def search_tossup_by_text(text: str):
-    session = models.create_session("data/acf-23-24.db")
+    session = models.create_session("data/acf-23-24.db", profile="analytics")
     return (
         session.query(models.Tossup)
         .filter(models.Tossup.question_text.contains(text))
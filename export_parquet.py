@@ -0,0 +1,253 @@
+"""
+Exports a database to Parquet: every table of `models.all_classes`, and the
+denormalized views of `queries.py`, as one Parquet dataset each.
+
+- Integer columns are stored in the smallest integer type holding their values, and
+  slug, category and other low-cardinality string columns are dictionary-encoded.
+- Rows are streamed from SQLite in row groups of `--batch_rows` rows, so no table is
+  ever fully held in memory. The column types are found beforehand with one aggregate
+  query per table or view.
+- Views with a column in `PARTITIONS` are partitioned by it, Hive-style, e.g.
+  `buzzpoints_info/tournament=acf-nats-2024/`.
+- Views over tables that the database does not have are skipped.
+
+Example usage:
+
+```bash
+python export_parquet.py data/acf-23-24.db data/acf-23-24.parquet
+```
+
+Reading only the columns and partitions a question needs, e.g. the buzzes by
+category of a tournament:
+
+```python
+buzzes = open_dataset("data/acf-23-24.parquet", "buzzpoints_info")
+table = buzzes.to_table(
+    columns=["question_category", "value"],
+    filter=pyarrow.dataset.field("tournament") == "acf-nats-2024",
+)
+```
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import sqlite3
+from typing import Dict, Iterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+from loguru import logger
+from sqlalchemy import Boolean, Date, Integer
+
+import queries
+from models import all_classes
+from utils.sqlite_profiles import PROFILES, connect
+
+VIEWS = {
+    name[: -len("_QUERY")].lower(): query
+    for name, query in vars(queries).items()
+    if name.endswith("_QUERY")
+}
+
+# Partition columns of the views
+PARTITIONS = {
+    "buzzpoints_info": ["tournament"],
+    "game_info": ["tournament"],
+}
+
+# Aliases of slug columns in the views
+SLUG_ALIASES = {
+    "tournament",
+    "team",
+    "team1",
+    "team2",
+    "player",
+    "qset",
+    "edition",
+    "level",
+    "difficulty",
+}
+
+INT_TYPES = [pa.int8(), pa.int16(), pa.int32(), pa.int64()]
+
+
+def is_dictionary_column(name: str) -> bool:
+    return "slug" in name or "category" in name or name in SLUG_ALIASES
+
+
+def column_stats(con: sqlite3.Connection, query: str, names: List[str]) -> List[tuple]:
+    """
+    (SQLite types, min integer, max integer) of each column of a query, with a single
+    scan of its rows.
+    """
+    parts = []
+    for name in names:
+        column = f'"{name}"'
+        integer = f"CASE WHEN typeof({column}) = 'integer' THEN {column} END"
+        parts += [
+            f"GROUP_CONCAT(DISTINCT typeof({column}))",
+            f"MIN({integer})",
+            f"MAX({integer})",
+        ]
+    row = con.execute(f"SELECT {', '.join(parts)} FROM ({query})").fetchone()
+    return [tuple(row[i : i + 3]) for i in range(0, len(row), 3)]
+
+
+def arrow_type(name: str, stats: tuple, model_column=None) -> pa.DataType:
+    """Arrow type of a column, given its `column_stats` and model column, if any."""
+    types, low, high = stats
+    types = set(types.split(",")) - {"null"} if types else set()
+    if model_column is not None:
+        if isinstance(model_column.type, Boolean):
+            return pa.bool_()
+        if isinstance(model_column.type, Date):
+            return pa.date32()
+        if isinstance(model_column.type, Integer) and not types:
+            return pa.int8()
+    if types == {"integer"}:
+        for int_type in INT_TYPES:
+            bound = 2 ** (int_type.bit_width - 1)
+            if -bound <= low and high < bound:
+                return int_type
+    if types and types <= {"integer", "real"}:
+        return pa.float64()
+    if is_dictionary_column(name):
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def converter(arrow_type: pa.DataType):
+    """Conversion of the non-NULL SQLite values of a column to its Arrow type."""
+    if pa.types.is_boolean(arrow_type):
+        return bool
+    if pa.types.is_date32(arrow_type):
+        return datetime.date.fromisoformat
+    if pa.types.is_string(arrow_type) or pa.types.is_dictionary(arrow_type):
+        return str
+    return None
+
+
+def record_batches(
+    cursor: sqlite3.Cursor, schema: pa.Schema, batch_rows: int
+) -> Iterator[pa.RecordBatch]:
+    """The rows of a cursor as record batches of `batch_rows` rows."""
+    converters = [converter(field.type) for field in schema]
+    while rows := cursor.fetchmany(batch_rows):
+        arrays = []
+        for values, field, convert in zip(zip(*rows), schema, converters):
+            if convert is not None:
+                values = [None if v is None else convert(v) for v in values]
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, field.type))
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_query(
+    con: sqlite3.Connection,
+    query: str,
+    path: str,
+    model_columns: Optional[Dict[str, object]] = None,
+    partitioning: Optional[List[str]] = None,
+    batch_rows: int = 100000,
+) -> None:
+    """Write the rows of a query to the Parquet dataset `path`."""
+    query = query.strip().rstrip(";")
+    names = [d[0] for d in con.execute(f"SELECT * FROM ({query}) LIMIT 0").description]
+    model_columns = model_columns or {}
+    partitioning = partitioning or []
+    fields = []
+    for name, stats in zip(names, column_stats(con, query, names)):
+        field_type = arrow_type(name, stats, model_columns.get(name))
+        if name in partitioning and pa.types.is_dictionary(field_type):
+            # Partition values are stored in the directory names
+            field_type = pa.string()
+        fields.append(pa.field(name, field_type))
+    schema = pa.schema(fields)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    ds.write_dataset(
+        record_batches(con.execute(query), schema, batch_rows),
+        path,
+        schema=schema,
+        format="parquet",
+        partitioning=partitioning or None,
+        partitioning_flavor="hive" if partitioning else None,
+        max_rows_per_group=batch_rows,
+    )
+
+
+def export_parquet(
+    db_path: str,
+    export_path: str,
+    batch_rows: int = 100000,
+    profile: str = "analytics",
+) -> None:
+    """Export the tables and views of a database as Parquet datasets in a directory."""
+    # The rows are read by the writer threads of pyarrow, one query at a time
+    con = connect(db_path, profile, check_same_thread=False)
+    tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master")}
+    for model_cls in all_classes:
+        table = model_cls.__table__
+        if table.name not in tables:
+            logger.info(f"Skipping table {table.name}, not in {db_path}")
+            continue
+        existing = {row[1] for row in con.execute(f'PRAGMA table_info("{table.name}")')}
+        columns = [c for c in table.columns if c.name in existing]
+        select = ", ".join(f'"{c.name}"' for c in columns)
+        logger.info(f"Exporting table {table.name}")
+        export_query(
+            con,
+            f'SELECT {select} FROM "{table.name}" ORDER BY id',
+            os.path.join(export_path, table.name),
+            {c.name: c for c in columns},
+            batch_rows=batch_rows,
+        )
+
+    for name, query in VIEWS.items():
+        try:
+            con.execute(f"SELECT * FROM ({query.strip().rstrip(';')}) LIMIT 0")
+        except sqlite3.OperationalError as e:
+            logger.info(f"Skipping view {name}: {e}")
+            continue
+        logger.info(f"Exporting view {name}")
+        export_query(
+            con,
+            query,
+            os.path.join(export_path, name),
+            partitioning=PARTITIONS.get(name),
+            batch_rows=batch_rows,
+        )
+    con.close()
+
+
+def open_dataset(export_path: str, name: str) -> ds.Dataset:
+    """Open an exported table or view, with its partitions as columns."""
+    return ds.dataset(
+        os.path.join(export_path, name), format="parquet", partitioning="hive"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a database to Parquet.")
+    parser.add_argument("db_path", help="Path to the database")
+    parser.add_argument("export_path", help="Directory of the Parquet datasets")
+    parser.add_argument(
+        "--batch_rows",
+        type=int,
+        default=100000,
+        help="Number of rows per row group, read from the database at a time",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default="analytics",
+        help="SQLite connection profile, see utils/sqlite_profiles.py",
+    )
+    args = parser.parse_args()
+
+    export_parquet(args.db_path, args.export_path, args.batch_rows, args.profile)
@@ -4,22 +4,47 @@ Merge multiple SQLite databases with the same schema into a single database.
 This script performs a topological sort on database tables based on their dependencies,
 then merges the tables in order, handling conflicts and duplicates.
 
+Progress is journaled in the target database, so an interrupted merge can be resumed
+at the first unfinished table with `--resume`.
+
 Example usage:
     python merge_db.py -i <input1.db> [<input2.db> ...] -o <output.db>
+    python merge_db.py -i <input1.db> [<input2.db> ...] -o <output.db> --resume
 """
 
 import argparse
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import shutil
+import sys
 from collections import defaultdict, deque
-from typing import Any, Dict, List, Optional, Type
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Type
 
+import numpy as np
 import sqlalchemy
 from loguru import logger
+from sqlalchemy.engine import Connection
 from sqlalchemy.inspection import inspect
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, defer
 
 import models
-from models import Base, all_classes, create_session
+from models import (
+    DERIVED_COLUMNS,
+    MAX_VARIABLES,
+    Base,
+    PacketQuestion,
+    all_classes,
+    check_packet_question_ids,
+    create_session,
+    dispose_engines,
+    get_serializer,
+)
+from utils.sqlite_profiles import WRITE_PROFILES, reset_journal_mode
 from utils.viz_utils import DiffVisualizer
 
 
@@ -77,12 +102,303 @@ def topo_sort_classes(dependencies: Dict[str, List[str]]) -> List[str]:
     return sorted_tables
 
 
-def merge_databases(source_db_path: str, target_db_path: str) -> None:
+def topo_levels(dependencies: Dict[str, List[str]]) -> List[List[str]]:
+    """
+    Group the classes into dependency levels: each table is one level above the highest
+    level of the tables it references, so the tables of a level are independent.
+    :return: The levels in order, each in topologically sorted order.
+    """
+    sorted_tables = topo_sort_classes(dependencies)
+    table_levels = {}
+    for table in sorted_tables:
+        table_levels.setdefault(table, 0)
+        for dependent in dependencies[table]:
+            table_levels[dependent] = max(
+                table_levels.get(dependent, 0), table_levels[table] + 1
+            )
+
+    levels = defaultdict(list)
+    for table in sorted_tables:
+        levels[table_levels[table]].append(table)
+    return [levels[level] for level in sorted(levels)]
+
+
+journal_metadata = sqlalchemy.MetaData()
+
+# Tables of each source db that are fully merged into the target db, with their id
+# mappings, so that an interrupted merge can resume at the first unfinished table.
+merge_journal = sqlalchemy.Table(
+    "merge_journal",
+    journal_metadata,
+    sqlalchemy.Column("source_hash", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("table_name", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("source_path", sqlalchemy.String),
+    sqlalchemy.Column("id_mapping", sqlalchemy.LargeBinary),
+    sqlalchemy.Column("merged_at", sqlalchemy.DateTime),
+)
+
+
+# Fingerprints of the merged records of each table, hashed over their non-PK values
+# after FK remapping, with the id of the target record they were merged into.
+merge_fingerprint = sqlalchemy.Table(
+    "merge_fingerprint",
+    journal_metadata,
+    sqlalchemy.Column("table_name", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("fingerprint", sqlalchemy.LargeBinary, primary_key=True),
+    sqlalchemy.Column("target_id", sqlalchemy.Integer),
+)
+
+
+# Differing fields of the records matched by merges, see `ConflictReport`.
+# `old` and `new` are JSON encoded.
+merge_conflict = sqlalchemy.Table(
+    "merge_conflict",
+    journal_metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("source_path", sqlalchemy.String),
+    sqlalchemy.Column("table_name", sqlalchemy.String),
+    sqlalchemy.Column("source_id", sqlalchemy.Integer),
+    sqlalchemy.Column("target_id", sqlalchemy.Integer),
+    sqlalchemy.Column("column_name", sqlalchemy.String),
+    sqlalchemy.Column("old", sqlalchemy.String),
+    sqlalchemy.Column("new", sqlalchemy.String),
+)
+
+
+def derived_column_queries(
+    conn: Connection, model_cls: Type[Base], schema: str = "main"
+) -> Dict[str, str]:
+    """
+    Get the queries selecting (id, value) for every source row of the `DERIVED_COLUMNS`
+    of `model_cls` that the source table in `schema` lacks or has NULLs in, by column
+    name. Existing values are kept, NULLs and missing columns are derived.
+    """
+    table_name = model_cls.__tablename__
+    source_columns = {
+        row[1]
+        for row in conn.exec_driver_sql(
+            f'PRAGMA {schema}.table_info("{table_name}")'
+        ).fetchall()
+    }
+
+    queries = {}
+    for column_name, derivation in DERIVED_COLUMNS.get(table_name, {}).items():
+        if column_name in source_columns:
+            has_nulls = conn.exec_driver_sql(
+                f'SELECT 1 FROM {schema}."{table_name}" '
+                f'WHERE "{column_name}" IS NULL LIMIT 1'
+            ).scalar()
+            if not has_nulls:
+                continue
+            value = f'COALESCE(s."{column_name}", d.value)'
+        else:
+            value = "d.value"
+
+        derivation = derivation.format(schema=schema)
+        ambiguous = conn.exec_driver_sql(
+            f"SELECT id FROM ({derivation}) WHERE n_values > 1 LIMIT 1"
+        ).scalar()
+        if ambiguous is not None:
+            raise ValueError(
+                f"Cannot derive {table_name}.{column_name} of record {ambiguous}, "
+                "it has several values"
+            )
+        logger.info(f"Deriving {table_name}.{column_name} of the source records")
+        queries[column_name] = (
+            f'SELECT s.id AS id, {value} AS value FROM {schema}."{table_name}" s '
+            f"LEFT JOIN ({derivation}) d ON d.id = s.id"
+        )
+    return queries
+
+
+def derive_columns(
+    session: Session, model_cls: Type[Base]
+) -> Dict[str, Dict[int, Any]]:
+    """
+    Compute the `derived_column_queries` of the source session, as
+    {column key: {source id: value}}.
+    """
+    conn = session.connection()
+    columns = {c.name: c for c in model_cls.non_pk_columns()}
+    return {
+        columns[column_name].key: dict(conn.exec_driver_sql(query).fetchall())
+        for column_name, query in derived_column_queries(conn, model_cls).items()
+    }
+
+
+def source_records_query(
+    model_cls: Type[Base], derived: Dict[str, Dict[int, Any]]
+) -> sqlalchemy.Select:
+    """Select the source records, without the derived columns, which may not exist."""
+    stmt = sqlalchemy.select(model_cls)
+    for key in derived:
+        stmt = stmt.options(defer(getattr(model_cls, key), raiseload=True))
+    return stmt
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 digest of the contents of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_journal(conn: Connection, source_hash: str) -> Dict[str, "IdMapping"]:
+    """
+    Load the id mappings of the tables of a source db that are already merged.
+    """
+    journal_metadata.create_all(conn)
+    rows = conn.execute(
+        sqlalchemy.select(merge_journal.c.table_name, merge_journal.c.id_mapping).where(
+            merge_journal.c.source_hash == source_hash
+        )
+    )
+    return {row.table_name: IdMapping.from_bytes(row.id_mapping) for row in rows}
+
+
+def record_journal(
+    conn: Connection,
+    source_db_path: str,
+    source_hash: str,
+    table_name: str,
+    id_mapping: "IdMapping",
+) -> None:
+    """
+    Record that a table of a source db is merged. Must be committed together with the
+    merged records of the table.
+    """
+    conn.execute(
+        merge_journal.insert().values(
+            source_hash=source_hash,
+            table_name=table_name,
+            source_path=os.path.abspath(source_db_path),
+            id_mapping=id_mapping.to_bytes(),
+            merged_at=datetime.now(),
+        )
+    )
+
+
+def record_fingerprint(record_data: Dict[str, Any]) -> bytes:
+    """Content hash of the (FK remapped) non-PK values of a record."""
+    return hashlib.blake2b(
+        repr(tuple(record_data.values())).encode(), digest_size=16
+    ).digest()
+
+
+def lookup_fingerprints(
+    conn: Connection, table_name: str, fingerprints: List[bytes]
+) -> Dict[bytes, int]:
+    """
+    Get the target ids of the records of a table merged before with these fingerprints.
+    """
+    known = {}
+    for start in range(0, len(fingerprints), MAX_VARIABLES):
+        rows = conn.execute(
+            sqlalchemy.select(
+                merge_fingerprint.c.fingerprint, merge_fingerprint.c.target_id
+            ).where(
+                merge_fingerprint.c.table_name == table_name,
+                merge_fingerprint.c.fingerprint.in_(
+                    fingerprints[start : start + MAX_VARIABLES]
+                ),
+            )
+        )
+        known.update((row.fingerprint, row.target_id) for row in rows)
+    return known
+
+
+def record_fingerprints(
+    conn: Connection,
+    table_name: str,
+    new_fingerprints: List[Tuple[bytes, int]],
+    table_id_mapping: Dict[int, int],
+) -> None:
+    """
+    Store the (fingerprint, source id) pairs of merged records with their target ids.
+    `new_fingerprints` is emptied.
+    """
+    if not new_fingerprints:
+        return
+    conn.execute(
+        merge_fingerprint.insert().prefix_with("OR IGNORE"),
+        [
+            {
+                "table_name": table_name,
+                "fingerprint": fingerprint,
+                "target_id": table_id_mapping[source_id],
+            }
+            for fingerprint, source_id in new_fingerprints
+        ],
+    )
+    new_fingerprints.clear()
+
+
+def create_conflict_report(
+    conflicts: Optional[str],
+    source_db_path: str,
+    connection: Callable[[], Connection],
+) -> Optional["ConflictReport"]:
+    """
+    Create the `ConflictReport` for the `conflicts` option of `merge_databases`:
+    None to log conflicts, "db" for the `merge_conflict` table or a JSONL file path.
+    """
+    if conflicts is None:
+        return None
+    if conflicts == "db":
+        return ConflictReport(source_db_path, connection=connection)
+    return ConflictReport(source_db_path, path=conflicts)
+
+
+def merge_databases(
+    source_db_path: str,
+    target_db_path: str,
+    use_index: bool = False,
+    bulk_insert: bool = False,
+    batch_size: int = 1000,
+    stream: bool = False,
+    incremental: bool = False,
+    conflicts: Optional[str] = None,
+    workers: int = 1,
+    profile: str = "default",
+) -> None:
     """
     Merge records from a source database into a target database.
+
+    If `use_index` is set, existing records are matched against an in-memory
+    `UniqueKeyIndex` of each target table instead of one query per source record.
+    If `bulk_insert` is set, new records are inserted `batch_size` at a time with
+    `bulk_insert_records` instead of one ORM flush per record.
+    If `stream` is set, source records are read and merged `batch_size` at a time.
+    If `incremental` is set, records that are unchanged since they were last merged
+    are skipped by their fingerprint. See `merge_table` for details.
+
+    The differing fields of matched records are logged, unless `conflicts` is "db" to
+    store them in the `merge_conflict` table of the target db, or the path of a JSONL
+    file to append them to (see `ConflictReport`).
+
+    If `workers` is more than 1, the tables are merged by `topo_levels`: the records
+    of all the tables of a level are read, remapped and matched at the same time by
+    `prepare_table` in `workers` processes, then written one table after another by
+    `apply_prepared_table`. New records are always inserted in batches, as with
+    `bulk_insert`, and `stream` is not supported.
+
+    The target db is opened with the connection `profile` of `utils.sqlite_profiles`,
+    and the source db is opened read-only.
+
+    Each table is committed together with its entry in the `merge_journal` of the
+    target db, so merging a source again (e.g. after a crash) skips the tables that
+    are already merged and restarts at the first unfinished one.
     """
-    session_source = create_session(source_db_path)
-    session_target = create_session(target_db_path, create_tables=True)
+    session_source = create_session(source_db_path, profile="read-only")
+    session_target = create_session(target_db_path, create_tables=True, profile=profile)
+
+    source_hash = file_hash(source_db_path)
+    merged_tables = load_journal(session_target.connection(), source_hash)
+    conflict_report = create_conflict_report(
+        conflicts, source_db_path, session_target.connection
+    )
 
     dependencies = get_class_dependencies()
     sorted_tables = topo_sort_classes(dependencies)
@@ -91,42 +407,290 @@ def merge_databases(source_db_path: str, target_db_path: str) -> None:
     name_to_class = {cls.__tablename__: cls for cls in all_classes}
     db_id_mapping = {}
 
-    # Merge each table in topologically sorted order
-    for table_name in sorted_tables:
-        base_class = name_to_class[table_name]
-        table_id_mapping = merge_table(
-            session_source, session_target, base_class, db_id_mapping
+    def finish_table(table_name: str, table_id_mapping: Dict[int, int]) -> None:
+        # Update id_mapping with the new ids
+        db_id_mapping[table_name] = IdMapping.from_dict(table_id_mapping)
+
+        record_journal(
+            session_target.connection(),
+            source_db_path,
+            source_hash,
+            table_name,
+            db_id_mapping[table_name],
         )
+        if conflict_report is not None:
+            conflict_report.flush()
+        session_target.commit()
+        if conflict_report is not None:
+            conflict_report.commit()
 
-        # Update id_mapping with the new ids
-        db_id_mapping[table_name] = table_id_mapping
+    if workers > 1:
+        if stream:
+            raise ValueError("Merging with several workers does not support stream")
+        levels = topo_levels(dependencies)
+        logger.info(f"Dependency levels: {levels}")
+    else:
+        levels = [[table_name] for table_name in sorted_tables]
 
-    session_target.commit()
+    # Spawned rather than forked, so that the workers do not inherit the open
+    # connections of this process
+    executor = (
+        ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        if workers > 1
+        else None
+    )
+
+    # Merge the tables level by level, each level in topologically sorted order
+    for level in levels:
+        for table_name in level:
+            if table_name in merged_tables:
+                logger.info(
+                    f"Skipping table already merged from this source: {table_name}"
+                )
+                db_id_mapping[table_name] = merged_tables[table_name]
+
+        level = [table_name for table_name in level if table_name not in merged_tables]
+        if executor is not None:
+            # Every table of the level only depends on the id mappings of lower levels
+            for table_name in level:
+                logger.info(f"Preparing table: {table_name}")
+            futures = [
+                executor.submit(
+                    prepare_table,
+                    source_db_path,
+                    target_db_path,
+                    name_to_class[table_name],
+                    dict(db_id_mapping),
+                    incremental=incremental,
+                    profile=profile,
+                )
+                for table_name in level
+            ]
+            for table_name, future in zip(level, futures):
+                table_id_mapping = apply_prepared_table(
+                    session_target,
+                    name_to_class[table_name],
+                    future.result(),
+                    batch_size=batch_size,
+                    conflicts=conflict_report,
+                )
+                finish_table(table_name, table_id_mapping)
+            continue
+
+        for table_name in level:
+            base_class = name_to_class[table_name]
+            table_id_mapping = merge_table(
+                session_source,
+                session_target,
+                base_class,
+                db_id_mapping,
+                use_index=use_index,
+                bulk_insert=bulk_insert,
+                batch_size=batch_size,
+                stream=stream,
+                incremental=incremental,
+                conflicts=conflict_report,
+            )
+            finish_table(table_name, table_id_mapping)
+
+    if executor is not None:
+        executor.shutdown()
     session_target.close()
     session_source.close()
+    # Close the connections, which checkpoints the WAL of the "bulk-write" profile
+    dispose_engines(target_db_path)
+    dispose_engines(source_db_path)
+    reset_journal_mode(target_db_path, profile)
 
 
-def create_diff_dict(old_record: Base, new_record: Base) -> Dict[str, Dict[str, Any]]:
+def create_diff_dict(
+    model_cls: Type[Base], old_values: Dict[str, Any], new_values: Dict[str, Any]
+) -> Dict[str, Dict[str, Any]]:
     """
-    Create a dictionary of differences between old_record and new_record.
-    The dictionary will contain both old and new values for each differing field.
+    Create a dictionary of differences between the non-PK values of two records,
+    keyed by column key. The dictionary will contain both old and new values for each
+    differing field, keyed by column name.
     """
     diff_dict = {}
-    for column in old_record.__table__.columns:
-        if column.primary_key:
-            continue
-        old_value = getattr(old_record, column.name)
-        new_value = getattr(new_record, column.name)
+    for column in model_cls.non_pk_columns():
+        old_value = old_values[column.key]
+        new_value = new_values[column.key]
         if old_value != new_value:
             diff_dict[column.name] = {"old": old_value, "new": new_value}
     return diff_dict
 
 
+def report_conflict(
+    conflicts: Optional["ConflictReport"],
+    table_name: str,
+    source_id: int,
+    target_id: int,
+    diff_dict: Dict[str, Dict[str, Any]],
+) -> None:
+    """
+    Report the differing fields of a source record matched to a target record, to
+    `conflicts` if given, else to the log.
+    """
+    if conflicts is not None:
+        conflicts.add(table_name, source_id, target_id, diff_dict)
+    else:
+        logger.info(
+            f"Record {source_id} of {table_name} matches record {target_id} but has "
+            f"different values for: \n{DiffVisualizer(diff_dict)}"
+        )
+
+
+def merge_matched_record(
+    conflicts: Optional["ConflictReport"],
+    model_cls: Type[Base],
+    source_id: int,
+    target_id: int,
+    old_values: Dict[str, Any],
+    record_data: Dict[str, Any],
+    table_id_mapping: Dict[int, int],
+) -> None:
+    """
+    Map a source record to the target record it matched, reporting their differing
+    fields if any.
+    """
+    # Only diff field by field if anything changed
+    if old_values != record_data:
+        report_conflict(
+            conflicts,
+            model_cls.__tablename__,
+            source_id,
+            target_id,
+            create_diff_dict(model_cls, old_values, record_data),
+        )
+    table_id_mapping[source_id] = target_id
+
+
+def filter_known_records(
+    conn: Connection,
+    model_cls: Type[Base],
+    records_from: List[Base],
+    records_data: List[Dict[str, Any]],
+) -> Tuple[List[Tuple[Base, Dict[str, Any]]], Dict[int, int], List[Tuple[bytes, int]]]:
+    """
+    Split source records by whether their `record_fingerprint` is in the
+    `merge_fingerprint` table of the target db.
+
+    Returns:
+      The (record, remapped values) pairs to merge, the source id -> target id of the
+      records that are unchanged since they were last merged, and the
+      (fingerprint, source id) pairs of the records to merge
+    """
+    fingerprints = [record_fingerprint(d) for d in records_data]
+    known_fingerprints = lookup_fingerprints(
+        conn, model_cls.__tablename__, fingerprints
+    )
+    to_merge, known, new_fingerprints = [], {}, []
+    for record, record_data, fingerprint in zip(
+        records_from, records_data, fingerprints
+    ):
+        if fingerprint in known_fingerprints:
+            known[record.id] = known_fingerprints[fingerprint]
+        else:
+            to_merge.append((record, record_data))
+            new_fingerprints.append((fingerprint, record.id))
+    return to_merge, known, new_fingerprints
+
+
+class ConflictReport:
+    """
+    Writes the differing fields of matched records in batches, as rows of
+    (source path, table, source id, target id, column, old value, new value).
+
+    Rows are inserted in the `merge_conflict` table of the target db, through the
+    connection returned by `connection()`, and must be flushed before the merged
+    records are committed. If `path` is given, batches are instead spooled to the
+    sidecar file `<path>.pending`, which `commit` appends to that JSONL file once the
+    table is committed, so that a table merged again after a crash (see `--resume`)
+    does not report its conflicts twice.
+    """
+
+    def __init__(
+        self,
+        source_db_path: str,
+        path: Optional[str] = None,
+        connection: Optional[Callable[[], Connection]] = None,
+        batch_size: int = 1000,
+    ):
+        self.source_path = os.path.abspath(source_db_path)
+        self.path = path
+        self.connection = connection
+        self.batch_size = batch_size
+        self.rows = []
+        if path is not None:
+            self.pending_path = f"{path}.pending"
+            # Left by a crashed merge, whose table was not committed
+            if os.path.exists(self.pending_path):
+                os.remove(self.pending_path)
+
+    def add(
+        self,
+        table_name: str,
+        source_id: int,
+        target_id: int,
+        diff_dict: Dict[str, Dict[str, Any]],
+    ) -> None:
+        for column_name, values in diff_dict.items():
+            self.rows.append(
+                {
+                    "source_path": self.source_path,
+                    "table_name": table_name,
+                    "source_id": source_id,
+                    "target_id": target_id,
+                    "column_name": column_name,
+                    "old": values["old"],
+                    "new": values["new"],
+                }
+            )
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Insert the pending rows in the `merge_conflict` table, or spool them to the
+        sidecar file.
+        """
+        if not self.rows:
+            return
+        if self.path is not None:
+            with open(self.pending_path, "a") as f:
+                f.writelines(json.dumps(row, default=str) + "\n" for row in self.rows)
+        else:
+            for row in self.rows:
+                row["old"] = json.dumps(row["old"], default=str)
+                row["new"] = json.dumps(row["new"], default=str)
+            self.connection().execute(merge_conflict.insert(), self.rows)
+        self.rows = []
+
+    def commit(self) -> None:
+        """Append the spooled rows of a committed table to the JSONL file."""
+        if self.path is None:
+            return
+        self.flush()
+        if not os.path.exists(self.pending_path):
+            return
+        with open(self.pending_path) as pending, open(self.path, "a") as f:
+            shutil.copyfileobj(pending, f)
+        os.remove(self.pending_path)
+
+
 def merge_table(
     session_from: Session,
     session_to: Session,
     model_cls: Type[Base],
-    db_id_mapping: Dict[str, Dict[int, int]],
+    db_id_mapping: Dict[str, "IdMapping"],
+    use_index: bool = False,
+    bulk_insert: bool = False,
+    batch_size: int = 1000,
+    stream: bool = False,
+    incremental: bool = False,
+    conflicts: Optional[ConflictReport] = None,
 ) -> Dict[int, int]:
     """Merge records from a source database session into a target database session for a given model class.
 
@@ -142,77 +706,490 @@ def merge_table(
       session_from: SQLAlchemy session for the source database
       session_to: SQLAlchemy session for the target database
       model_cls: The SQLAlchemy model class representing the table to be merged
+      db_id_mapping: Mapping of already merged tables to their `IdMapping`
+      use_index: Match existing records with a `UniqueKeyIndex` built once from the
+        target table instead of calling `record_exists` for every source record
+      bulk_insert: Insert new records in batches with `bulk_insert_records` instead of
+        flushing them one by one. Implies `use_index`, since pending records can only
+        be matched in memory.
+      batch_size: Number of new records per batched INSERT when `bulk_insert` is set,
+        and number of source records per chunk when `stream` is set
+      stream: Read the source records `batch_size` at a time instead of all at once.
+        Each chunk is matched against only the target records it may match, fetched
+        with `fetch_candidates`, and all processed objects are expunged from both
+        sessions before the next chunk, so memory use is bounded by `batch_size`.
+      incremental: Map source records whose `record_fingerprint` is already in the
+        `merge_fingerprint` table of the target db straight to the target record they
+        were merged into before, without matching or diffing them. The fingerprints of
+        all other records are stored once they are merged.
+      conflicts: Report the differing fields of matched records to this `ConflictReport`
+        instead of the log
 
     Returns:
       A dictionary mapping original record IDs to new IDs in the target database
     """
 
-    # Get all records from both databases
     logger.info(f"Merging table: {model_cls.__tablename__}")
-    records_from = session_from.query(model_cls).all()
-    records_to = session_to.query(model_cls).all()
+    logger.info(f"# Records in target db: {count_records(session_to, model_cls)}")
+    logger.info(f"# Records in source db: {count_records(session_from, model_cls)}")
 
-    logger.info(f"# Records in target db: {len(records_to)}")
-    logger.info(f"# Records in source db: {len(records_from)}")
+    derived = derive_columns(session_from, model_cls)
+    stmt = source_records_query(model_cls, derived)
+    serializer = get_serializer(model_cls)
+    index = None
+    if stream:
+        stmt = stmt.execution_options(yield_per=batch_size)
+        chunks = session_from.scalars(stmt).partitions()
+    else:
+        chunks = [session_from.scalars(stmt).all()]
+        if use_index or bulk_insert:
+            index = UniqueKeyIndex(model_cls, session_to.query(model_cls).all())
 
     table_id_mapping = {}
+    # (source id, new record) pairs waiting for the next batched INSERT
+    pending = []
 
-    for record in records_from:
-        # Create a dictionary of non-PK and non-FK fields
-        record_data = {}
-        for col in model_cls.__table__.columns:
-            if col.primary_key:
-                continue
-            if col.foreign_keys:
-                # Use id_mapping to get the new foreign key
-                assert len(col.foreign_keys) == 1, (
-                    "Expected 1 foreign key, got composite foreign key of length "
-                    f"{len(col.foreign_keys)} for column {col.name}"
-                )
-                fk = list(col.foreign_keys)[0]
-                related_table = fk.column.table.name
-                related_id = getattr(record, col.key)
-                record_data[col.key] = db_id_mapping[related_table][related_id]
+    # (fingerprint, source id) pairs of the records merged by matching or inserting
+    new_fingerprints = []
+
+    for records_from in chunks:
+        records_data = remap_records(records_from, model_cls, db_id_mapping, derived)
+        to_merge = list(zip(records_from, records_data))
+        if incremental:
+            to_merge, known, chunk_fingerprints = filter_known_records(
+                session_to.connection(), model_cls, records_from, records_data
+            )
+            # Unchanged since they were last merged
+            table_id_mapping.update(known)
+            new_fingerprints.extend(chunk_fingerprints)
+
+        if stream:
+            candidates = fetch_candidates(
+                session_to, model_cls, [record_data for _, record_data in to_merge]
+            )
+            index = UniqueKeyIndex(model_cls, candidates)
+
+        for record, record_data in to_merge:
+            if index is not None:
+                existing_record = index.lookup(record_data)
             else:
-                record_data[col.key] = getattr(record, col.key)
+                existing_record = record_exists(session_to, model_cls, record_data)
 
-        existing_record = record_exists(session_to, model_cls, record_data)
+            if existing_record is None and bulk_insert:
+                new_record = model_cls(**record_data)
+                pending.append((record.id, new_record))
+                index.add(new_record)
+                if len(pending) >= batch_size:
+                    bulk_insert_records(
+                        session_to, model_cls, pending, table_id_mapping
+                    )
+            elif existing_record is None:
+                new_record = model_cls(**record_data)
+                session_to.add(new_record)
+                session_to.flush()
+                table_id_mapping[record.id] = new_record.id
+                if index is not None:
+                    index.add(new_record)
+            else:
+                if existing_record.id is None:
+                    # Matched a record of this source that is not inserted yet
+                    bulk_insert_records(
+                        session_to, model_cls, pending, table_id_mapping
+                    )
+                merge_matched_record(
+                    conflicts,
+                    model_cls,
+                    record.id,
+                    existing_record.id,
+                    serializer.non_pk_dict(existing_record),
+                    record_data,
+                    table_id_mapping,
+                )
 
-        new_record = model_cls(**record_data)
-        if existing_record is None:
-            session_to.add(new_record)
-            session_to.flush()
-            table_id_mapping[record.id] = new_record.id
-        else:
-            diff_dict = create_diff_dict(existing_record, new_record)
-            if diff_dict:
-                logger.info(
-                    f"New record with id {new_record.id} has different values for: "
-                    f"\n{DiffVisualizer(diff_dict)}"
+        if stream:
+            # Later chunks find the records of this chunk in the target db
+            bulk_insert_records(session_to, model_cls, pending, table_id_mapping)
+            record_fingerprints(
+                session_to.connection(),
+                model_cls.__tablename__,
+                new_fingerprints,
+                table_id_mapping,
+            )
+            for record in records_from:
+                session_from.expunge(record)
+            session_to.expunge_all()
+
+    bulk_insert_records(session_to, model_cls, pending, table_id_mapping)
+    record_fingerprints(
+        session_to.connection(),
+        model_cls.__tablename__,
+        new_fingerprints,
+        table_id_mapping,
+    )
+
+    logger.info(f"# Records in target db: {count_records(session_to, model_cls)}")
+
+    return table_id_mapping
+
+
+class PreparedTable(NamedTuple):
+    """
+    Source records of a table that are remapped and matched, but not written yet, as
+    plain values so that they can be prepared in another process.
+    """
+
+    # Source id -> target id of the records skipped by their fingerprint
+    known: Dict[int, int]
+    # (source id, remapped values, target id, matched source id, old values) in source
+    # order. New records to insert have no target id and no old values. A record that
+    # matched a record of the target db has its target id and old values, and one that
+    # matched a new record of this source inserted before it has the source id and
+    # values of that record instead.
+    steps: List[
+        Tuple[int, Dict[str, Any], Optional[int], Optional[int], Optional[Dict]]
+    ]
+    # (fingerprint, source id) pairs of the records to merge
+    new_fingerprints: List[Tuple[bytes, int]]
+
+
+def prepare_table(
+    source_db_path: str,
+    target_db_path: str,
+    model_cls: Type[Base],
+    db_id_mapping: Dict[str, "IdMapping"],
+    incremental: bool = False,
+    profile: str = "default",
+) -> PreparedTable:
+    """
+    Read, remap and match the source records of `model_cls` against the target db as
+    `merge_table` does with `bulk_insert`, without writing anything. Uses its own
+    sessions, so that the tables of a level can be prepared in parallel processes.
+    """
+    session_from = create_session(source_db_path, profile="read-only")
+    session_to = create_session(target_db_path, profile=profile)
+    try:
+        derived = derive_columns(session_from, model_cls)
+        stmt = source_records_query(model_cls, derived)
+        records_from = session_from.scalars(stmt).all()
+        records_data = remap_records(records_from, model_cls, db_id_mapping, derived)
+        to_merge = list(zip(records_from, records_data))
+        known, new_fingerprints = {}, []
+        if incremental:
+            to_merge, known, new_fingerprints = filter_known_records(
+                session_to.connection(), model_cls, records_from, records_data
+            )
+
+        serializer = get_serializer(model_cls)
+        index = UniqueKeyIndex(model_cls, session_to.query(model_cls).all())
+        # Source id of each new record, by object id
+        new_source_ids = {}
+        steps = []
+        for record, record_data in to_merge:
+            existing_record = index.lookup(record_data)
+            if existing_record is None:
+                new_record = model_cls(**record_data)
+                index.add(new_record)
+                new_source_ids[id(new_record)] = record.id
+                steps.append((record.id, record_data, None, None, None))
+            elif existing_record.id is None:
+                steps.append(
+                    (
+                        record.id,
+                        record_data,
+                        None,
+                        new_source_ids[id(existing_record)],
+                        serializer.non_pk_dict(existing_record),
+                    )
+                )
+            else:
+                steps.append(
+                    (
+                        record.id,
+                        record_data,
+                        existing_record.id,
+                        None,
+                        serializer.non_pk_dict(existing_record),
+                    )
                 )
-            table_id_mapping[record.id] = existing_record.id
+    finally:
+        session_to.close()
+        session_from.close()
+        # Do not keep connections to the target db open in worker processes
+        dispose_engines(target_db_path)
+        dispose_engines(source_db_path)
+    return PreparedTable(known, steps, new_fingerprints)
+
 
-    records_to = session_to.query(model_cls).all()
-    logger.info(f"# Records in target db: {len(records_to)}")
+def apply_prepared_table(
+    session_to: Session,
+    model_cls: Type[Base],
+    prepared: PreparedTable,
+    batch_size: int = 1000,
+    conflicts: Optional[ConflictReport] = None,
+) -> Dict[int, int]:
+    """
+    Write a `PreparedTable` to the target session: insert its new records in batches
+    and report the conflicts of its matched records, exactly as `merge_table` would.
+
+    Returns:
+      A dictionary mapping original record IDs to new IDs in the target database
+    """
+    logger.info(f"Merging table: {model_cls.__tablename__}")
+    logger.info(f"# Records in target db: {count_records(session_to, model_cls)}")
+
+    table_id_mapping = dict(prepared.known)
+    pending = []
+    for source_id, record_data, target_id, matched_id, old_values in prepared.steps:
+        if old_values is None:
+            pending.append((source_id, model_cls(**record_data)))
+            if len(pending) >= batch_size:
+                bulk_insert_records(session_to, model_cls, pending, table_id_mapping)
+            continue
+
+        if target_id is None:
+            if matched_id not in table_id_mapping:
+                # Matched a record of this source that is not inserted yet
+                bulk_insert_records(session_to, model_cls, pending, table_id_mapping)
+            target_id = table_id_mapping[matched_id]
+        merge_matched_record(
+            conflicts,
+            model_cls,
+            source_id,
+            target_id,
+            old_values,
+            record_data,
+            table_id_mapping,
+        )
+
+    bulk_insert_records(session_to, model_cls, pending, table_id_mapping)
+    record_fingerprints(
+        session_to.connection(),
+        model_cls.__tablename__,
+        list(prepared.new_fingerprints),
+        table_id_mapping,
+    )
 
+    logger.info(f"# Records in target db: {count_records(session_to, model_cls)}")
     return table_id_mapping
 
 
+def count_records(session: Session, model_cls: Type[Base]) -> int:
+    return session.scalar(sqlalchemy.select(sqlalchemy.func.count(model_cls.id)))
+
+
+def remap_records(
+    records: List[Base],
+    model_cls: Type[Base],
+    db_id_mapping: Dict[str, "IdMapping"],
+    derived: Optional[Dict[str, Dict[int, Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Create a dictionary of the non-PK fields of each source record, with the foreign
+    keys translated to the ids of the already merged target records.
+
+    Each foreign key column is translated for all the records at once. The values of
+    the columns in `derived` (see `derive_columns`) are taken from it by source id.
+    """
+    derived = derived or {}
+    columns = {}
+    for col in model_cls.non_pk_columns():
+        if col.key in derived:
+            values = [derived[col.key].get(record.id) for record in records]
+        else:
+            values = [getattr(record, col.key) for record in records]
+        if col.foreign_keys:
+            # Use id_mapping to get the new foreign key
+            assert len(col.foreign_keys) == 1, (
+                "Expected 1 foreign key, got composite foreign key of length "
+                f"{len(col.foreign_keys)} for column {col.name}"
+            )
+            fk = list(col.foreign_keys)[0]
+            related_table = fk.column.table.name
+            values = db_id_mapping[related_table].translate(values).tolist()
+        columns[col.key] = values
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+class IdMapping:
+    """
+    Compact {old id: new id} mapping of a merged table, backed by NumPy arrays.
+
+    If the old ids are (nearly) contiguous, the new ids are stored in a dense array
+    indexed by `old id - offset`, with -1 for the gaps. Otherwise the old and new ids
+    are stored as sorted key / value arrays, searched with `np.searchsorted`.
+    """
+
+    # Max ratio between the range of old ids and their count for a dense array
+    MAX_DENSE_RATIO = 2
+    MISSING = -1
+
+    def __init__(self, old_ids, new_ids):
+        old_ids = np.asarray(old_ids, dtype=np.int64)
+        new_ids = np.asarray(new_ids, dtype=np.int64)
+        order = np.argsort(old_ids)
+        old_ids, new_ids = old_ids[order], new_ids[order]
+
+        self.offset = int(old_ids[0]) if len(old_ids) else 0
+        span = int(old_ids[-1]) - self.offset + 1 if len(old_ids) else 0
+        if span <= self.MAX_DENSE_RATIO * len(old_ids):
+            self.keys = None
+            self.values = np.full(span, self.MISSING, dtype=np.int64)
+            self.values[old_ids - self.offset] = new_ids
+        else:
+            self.keys = old_ids
+            self.values = new_ids
+        self.size = len(old_ids)
+
+    @classmethod
+    def from_dict(cls, mapping: Dict[int, int]) -> "IdMapping":
+        return cls(list(mapping.keys()), list(mapping.values()))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, old_id: int) -> int:
+        return int(self.translate([old_id])[0])
+
+    def translate(self, old_ids) -> np.ndarray:
+        """
+        Translate an array of old ids to new ids. Raises a KeyError for the first old
+        id that is not in the mapping, like a dict lookup.
+        """
+        try:
+            old_ids = np.asarray(old_ids, dtype=np.int64)
+        except TypeError:
+            # A NULL foreign key
+            raise KeyError(None) from None
+        if self.keys is None:
+            positions = old_ids - self.offset
+            found = (positions >= 0) & (positions < len(self.values))
+            found[found] = self.values[positions[found]] != self.MISSING
+        else:
+            positions = np.searchsorted(self.keys, old_ids)
+            found = positions < len(self.keys)
+            found[found] = self.keys[positions[found]] == old_ids[found]
+        if not found.all():
+            raise KeyError(int(old_ids[~found][0]))
+        return self.values[positions]
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The old ids in increasing order and their new ids."""
+        if self.keys is None:
+            positions = np.flatnonzero(self.values != self.MISSING)
+            return positions + self.offset, self.values[positions]
+        return self.keys, self.values
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the mapping arrays."""
+        keys_nbytes = 0 if self.keys is None else self.keys.nbytes
+        return keys_nbytes + self.values.nbytes
+
+    def items(self):
+        old_ids, new_ids = self.arrays()
+        return zip(old_ids.tolist(), new_ids.tolist())
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.save(buffer, np.stack(self.arrays()))
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "IdMapping":
+        old_ids, new_ids = np.load(io.BytesIO(data))
+        return cls(old_ids, new_ids)
+
+
+def fetch_candidates(
+    session: Session, model_cls: Type[Base], records_data: List[Dict[str, Any]]
+) -> List[Base]:
+    """
+    Fetch the target records that `record_exists` could return for any of the given
+    records, ordered by id.
+
+    Records are grouped by which of their unique values are None, and each group is
+    fetched with IN queries on its non-None unique columns, binding at most
+    `MAX_VARIABLES` values each.
+    """
+    unique_columns = get_unique_columns(model_cls)
+    keys_by_positions = defaultdict(set)
+    for record_data in records_data:
+        values = [record_data[c.key] for c in unique_columns]
+        positions = tuple(i for i, v in enumerate(values) if v is not None)
+        keys_by_positions[positions].add(tuple(values[i] for i in positions))
+
+    candidates = {}
+    for positions, keys in keys_by_positions.items():
+        columns = [getattr(model_cls, unique_columns[i].key) for i in positions]
+        if not columns:
+            query = session.query(model_cls).order_by(model_cls.id).limit(1)
+            for record in query:
+                candidates[record.id] = record
+            continue
+        keys = list(keys)
+        chunk_size = max(1, MAX_VARIABLES // len(columns))
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start : start + chunk_size]
+            query = session.query(model_cls)
+            if len(columns) == 1:
+                query = query.filter(columns[0].in_([key[0] for key in chunk]))
+            else:
+                query = query.filter(sqlalchemy.tuple_(*columns).in_(chunk))
+            for record in query:
+                candidates[record.id] = record
+    return [candidates[i] for i in sorted(candidates)]
+
+
+def bulk_insert_records(
+    session: Session,
+    model_cls: Type[Base],
+    pending: List[Tuple[int, Base]],
+    table_id_mapping: Dict[int, int],
+) -> None:
+    """
+    Insert the pending (source id, new record) pairs with a single batched
+    INSERT ... RETURNING, then set the new ids on the records and in `table_id_mapping`.
+
+    The pending records are never added to the session, so the ORM events do not see
+    them: inserted PacketQuestions are checked with `models.check_packet_question_ids`
+    instead. `pending` is emptied.
+    """
+    if not pending:
+        return
+    columns = [c.key for c in model_cls.non_pk_columns()]
+    rows = get_serializer(model_cls).dicts([record for _, record in pending], columns)
+    stmt = sqlalchemy.insert(model_cls).returning(
+        model_cls.id, sort_by_parameter_order=True
+    )
+    new_ids = session.execute(stmt, rows).scalars().all()
+    if model_cls is PacketQuestion:
+        check_packet_question_ids(session, new_ids)
+    for (source_id, record), new_id in zip(pending, new_ids):
+        record.id = new_id
+        table_id_mapping[source_id] = new_id
+    pending.clear()
+
+
+def get_unique_columns(model_cls: Type[Base]) -> List[sqlalchemy.Column]:
+    """
+    Get the columns that identify a record of `model_cls` across databases, in table order.
+
+    These are the columns of all the UniqueConstraints of the table, or all the non-PK
+    columns if the table has no unique constraints.
+    """
+    return list(get_serializer(model_cls).unique_columns)
+
+
 def record_exists(
     session: Session, model_cls: Type[Base], record_data: Dict[str, Any]
 ) -> Optional[Base]:
     """
     Check if a record exists in the database and return its primary key, else return None.
-    """
-    # Get unique constraints for the table
-    unique_constraints = model_cls.__table__.constraints
-    unique_columns = set()
-    for constraint in unique_constraints:
-        if isinstance(constraint, sqlalchemy.UniqueConstraint):
-            unique_columns.update(constraint.columns)
 
-    # If no unique constraints, fall back to all non-primary key columns
-    unique_columns = unique_columns or model_cls.non_pk_columns()
+    NULL unique values are left out of the match, so several records may match; the
+    one with the lowest id is returned, as by `UniqueKeyIndex` and `merge_sql`.
+    """
+    unique_columns = get_unique_columns(model_cls)
 
     # Build the filter condition based on unique columns
     filter_conditions = []
@@ -222,11 +1199,60 @@ def record_exists(
             filter_conditions.append(getattr(model_cls, column.key) == value)
 
     # Query the database
-    existing_record = session.query(model_cls).filter(*filter_conditions).first()
+    existing_record = (
+        session.query(model_cls)
+        .filter(*filter_conditions)
+        .order_by(model_cls.id)
+        .first()
+    )
 
     return existing_record
 
 
+class UniqueKeyIndex:
+    """
+    In-memory replacement for `record_exists` over the records of a single target table.
+
+    Records are hashed by the values of their unique columns. As in `record_exists`, None
+    values in a lookup are left out of the match, so a lookup only compares the columns
+    it has values for. One hash table is kept per such subset of columns; it is built on
+    first use and kept up to date by `add`. When several records match, the one added
+    first (i.e. the lowest id) is returned.
+    """
+
+    def __init__(self, model_cls: Type[Base], records: List[Base]):
+        self.keys = [c.key for c in get_unique_columns(model_cls)]
+        self.unique_values = get_serializer(model_cls).unique_values
+        self.entries = []
+        # Positions of the non-None lookup values -> {values at positions: record}
+        self.indexes: Dict[tuple, Dict[tuple, Base]] = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record: Base) -> None:
+        values = self.unique_values(record)
+        self.entries.append((values, record))
+        for positions, index in self.indexes.items():
+            self._insert(index, positions, values, record)
+
+    def lookup(self, record_data: Dict[str, Any]) -> Optional[Base]:
+        values = [record_data[k] for k in self.keys]
+        positions = tuple(i for i, v in enumerate(values) if v is not None)
+        index = self.indexes.get(positions)
+        if index is None:
+            index = self.indexes[positions] = {}
+            for entry_values, record in self.entries:
+                self._insert(index, positions, entry_values, record)
+        return index.get(tuple(values[i] for i in positions))
+
+    @staticmethod
+    def _insert(index, positions, values, record) -> None:
+        key = tuple(values[i] for i in positions)
+        # NULLs never compare equal in SQL, so such records can't match on these columns
+        if None not in key:
+            index.setdefault(key, record)
+
+
 # %%
 if __name__ == "__main__":
     # Run the merge
@@ -235,16 +1261,137 @@ if __name__ == "__main__":
     parser.add_argument(
         "--src_dbs", "-i", nargs="+", help="Paths to the source databases to merge"
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the existing target database and resume an interrupted merge",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["orm", "sql"],
+        default="orm",
+        help="Merge through ORM objects, or entirely in SQLite (see merge_sql.py)",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=0,
+        help="Merge the sources by tree reduction with this many worker processes",
+    )
+    parser.add_argument(
+        "--log_file",
+        help="File collecting the merge logs of --parallel (default: <target_db>.merge.log)",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only report what the merge would do per table, and estimate its cost, "
+        "without changing the target database",
+    )
+    parser.add_argument(
+        "--conflicts",
+        help='Report differing fields of matched records to the "merge_conflict" '
+        'table of the target database with "db", or to a JSONL file with its path, '
+        "instead of the log",
+    )
+    parser.add_argument(
+        "--use_index",
+        action="store_true",
+        help="Match existing records with an in-memory unique-key index",
+    )
+    parser.add_argument(
+        "--bulk_insert",
+        action="store_true",
+        help="Insert new records in batches instead of one ORM flush per record",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read and merge source records in chunks to bound memory use",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip records that are unchanged since they were last merged",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes preparing the independent tables of each "
+        "dependency level at the same time",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=WRITE_PROFILES,
+        default="bulk-write",
+        help="SQLite connection profile of the target database, see "
+        "utils/sqlite_profiles.py",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="Number of records per batch for --bulk_insert and --stream",
+    )
     args = parser.parse_args()
+    if args.engine == "sql":
+        # merge_sql.merge_databases_sql only takes --conflicts and --profile
+        unsupported = [
+            option
+            for option, is_set in [
+                ("--use_index", args.use_index),
+                ("--bulk_insert", args.bulk_insert),
+                ("--stream", args.stream),
+                ("--incremental", args.incremental),
+                ("--workers", args.workers > 1),
+            ]
+            if is_set
+        ]
+        if unsupported:
+            parser.error(f"--engine sql does not support {', '.join(unsupported)}")
 
     src_db_paths = args.src_dbs
     target_db_path = args.target_db
 
-    if os.path.exists(target_db_path):
+    if args.plan:
+        from merge_plan import format_plan, plan_merge
+
+        # Without --resume the merge starts from an empty target
+        plan = plan_merge(src_db_paths, target_db_path if args.resume else None)
+        logger.info(f"Merge plan:\n{format_plan(plan)}")
+        sys.exit(0)
+
+    if os.path.exists(target_db_path) and not args.resume:
         os.remove(target_db_path)
 
-    for src_db_path in src_db_paths:
-        merge_databases(src_db_path, target_db_path)
+    merge_kwargs = dict(
+        use_index=args.use_index,
+        bulk_insert=args.bulk_insert,
+        batch_size=args.batch_size,
+        stream=args.stream,
+        incremental=args.incremental,
+        conflicts=args.conflicts,
+        workers=args.workers,
+        profile=args.profile,
+    )
+    if args.parallel:
+        from merge_tree import merge_tree
+
+        log_path = args.log_file or f"{target_db_path}.merge.log"
+        merge_tree(
+            src_db_paths,
+            target_db_path,
+            args.parallel,
+            log_path,
+            engine=args.engine,
+            resume=args.resume,
+            **merge_kwargs,
+        )
+    else:
+        from merge_tree import merge_sources
+
+        merge_sources(src_db_paths, target_db_path, args.engine, **merge_kwargs)
 
     session = create_session(target_db_path)
     t = session.query(models.Tossup).first()
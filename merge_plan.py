@@ -0,0 +1,131 @@
+"""
+Dry-run planner for merges.
+
+The sources are merged into the target with the set-based SQL of `merge_sql.py`, in a
+single transaction that is rolled back at the end, so the target is left untouched.
+Since the plan runs the same statements as `--engine sql`, its counts are exact and
+its timings estimate the runtime of that engine. Tables already merged from a source,
+according to the target's `merge_journal`, are reported as skipped.
+
+Example usage:
+    python merge_db.py -i <input1.db> [<input2.db> ...] -o <output.db> --plan
+"""
+
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+from merge_db import file_hash, get_class_dependencies, load_journal, topo_sort_classes
+from merge_sql import create_map_table, merge_table_sql, quote, read_map_table
+from models import Base, all_classes, create_transactional_engine
+
+# Columns of the plan, as (key, header)
+PLAN_COLUMNS = [
+    ("source", "rows"),
+    ("inserted", "insert"),
+    ("matched", "match"),
+    ("duplicates", "dup"),
+    ("conflicts", "differ"),
+    ("id_map_bytes", "id map"),
+    ("seconds", "est. s"),
+]
+
+
+def plan_merge(
+    src_db_paths: List[str], target_db_path: Optional[str]
+) -> List[Dict[str, object]]:
+    """
+    Plan the merge of the source databases, one after another, into the target, or
+    into an empty target if `target_db_path` is None or does not exist.
+
+    Returns:
+      One entry per source and table, in merge order, with the number of source rows
+      that would be inserted, matched to existing rows, matched to inserted rows of
+      the same source and matched with different values, the size of the id map and
+      the time taken by the SQL merge. Skipped tables have `skipped` set.
+    """
+    if target_db_path is not None and not os.path.exists(target_db_path):
+        target_db_path = None
+    engine = create_transactional_engine(target_db_path)
+
+    sorted_tables = topo_sort_classes(get_class_dependencies())
+    name_to_class = {cls.__tablename__: cls for cls in all_classes}
+
+    plan = []
+    with engine.connect() as conn:
+        # Each source stays attached until the rollback, since a database that was
+        # read in a transaction cannot be detached
+        limit = conn.connection.dbapi_connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if len(src_db_paths) > limit:
+            raise ValueError(
+                f"Cannot plan more than {limit} sources at a time, plan the merge of "
+                "the first sources with --resume instead"
+            )
+
+        transaction = conn.begin()
+        Base.metadata.create_all(conn)
+        for i, src_db_path in enumerate(src_db_paths):
+            schema = f"src_{i}"
+            conn.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (src_db_path,))
+            merged_tables = load_journal(conn, file_hash(src_db_path))
+            for table_name in sorted_tables:
+                entry = {"path": src_db_path, "table": table_name}
+                plan.append(entry)
+                if table_name in merged_tables:
+                    entry["skipped"] = True
+                    create_map_table(conn, table_name, merged_tables[table_name])
+                    continue
+
+                entry["source"] = conn.exec_driver_sql(
+                    f"SELECT COUNT(*) FROM {schema}.{quote(table_name)}"
+                ).scalar()
+                start = time.perf_counter()
+                entry.update(
+                    merge_table_sql(
+                        conn, name_to_class[table_name], schema=schema, dry_run=True
+                    )
+                )
+                entry["seconds"] = time.perf_counter() - start
+                entry["id_map_bytes"] = read_map_table(conn, table_name).nbytes
+
+            for table_name in sorted_tables:
+                conn.exec_driver_sql(f"DROP TABLE temp.{quote('map_' + table_name)}")
+        transaction.rollback()
+    engine.dispose()
+    return plan
+
+
+def format_plan(plan: List[Dict[str, object]]) -> str:
+    """Format a plan as one table per source, with totals."""
+    lines = []
+    widths = [max(len(header), 12) for _, header in PLAN_COLUMNS]
+    table_width = max(len(table) for table in {entry["table"] for entry in plan})
+
+    def format_row(name, values):
+        cells = [f"{value:>{width}}" for value, width in zip(values, widths)]
+        return f"{name:<{table_width}}  " + "  ".join(cells)
+
+    def format_values(entry):
+        return [
+            f"{entry[key]:.2f}" if key == "seconds" else f"{entry[key]:,}"
+            for key, _ in PLAN_COLUMNS
+        ]
+
+    totals = dict.fromkeys((key for key, _ in PLAN_COLUMNS), 0)
+    path = None
+    for entry in plan:
+        if entry["path"] != path:
+            path = entry["path"]
+            lines.append(f"\nMerge of {path}")
+            lines.append(format_row("table", [header for _, header in PLAN_COLUMNS]))
+        if entry.get("skipped"):
+            lines.append(format_row(entry["table"], ["skipped"]))
+            continue
+        lines.append(format_row(entry["table"], format_values(entry)))
+        for key in totals:
+            totals[key] += entry[key]
+
+    lines.append("")
+    lines.append(format_row("total", format_values(totals)))
+    return "\n".join(lines)
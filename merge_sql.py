@@ -0,0 +1,475 @@
+"""
+Pure-SQL engine for merging a source database into a target database.
+
+Instead of loading every record as an ORM object, the source database is ATTACHed to
+the target and each table is merged with set-based SQL, in the same topological order
+and with the same matching rules as `merge_db.merge_table`:
+
+1. The source rows are copied to `temp.merge_src` with their foreign keys remapped
+   through the `temp.map_<table>` tables of the already merged tables.
+2. Rows are matched to existing target rows on their unique columns. NULL values are
+   left out of the match, as in `merge_db.record_exists`, so there is one join per
+   pattern of NULL values.
+3. Unmatched rows that match an earlier inserted row of the same source are mapped to
+   that row instead of being inserted.
+4. The remaining rows are inserted with INSERT ... SELECT, using the ids the ORM engine
+   would have assigned, and all old -> new ids are stored in `temp.map_<table>`.
+
+Example usage:
+    python merge_db.py -i <input1.db> [<input2.db> ...] -o <output.db> --engine sql
+"""
+
+from typing import Any, Dict, List, Optional, Type
+
+import sqlalchemy
+from loguru import logger
+from sqlalchemy.engine import Connection
+
+from merge_db import (
+    ConflictReport,
+    IdMapping,
+    create_conflict_report,
+    create_diff_dict,
+    derived_column_queries,
+    file_hash,
+    get_class_dependencies,
+    get_unique_columns,
+    load_journal,
+    record_journal,
+    report_conflict,
+    topo_sort_classes,
+)
+from models import (
+    MAX_VARIABLES,
+    Base,
+    PacketQuestion,
+    all_classes,
+    check_packet_questions,
+    create_sqlite_engine,
+)
+from utils.sqlite_profiles import reset_journal_mode
+
+# Row states of `temp.merge_src`
+UNDECIDED, MATCHED, INSERTED, DUPLICATE = 0, 1, 2, 3
+
+
+def quote(name: str) -> str:
+    return f'"{name}"'
+
+
+def merge_databases_sql(
+    source_db_path: str,
+    target_db_path: str,
+    conflicts: Optional[str] = None,
+    profile: str = "default",
+) -> None:
+    """
+    Merge records from a source database into a target database, entirely within SQLite.
+
+    Like `merge_db.merge_databases`, each table is committed with its `merge_journal`
+    entry, tables already merged from this source are skipped, and conflicts are
+    reported according to `conflicts`. The target db is opened with the connection
+    `profile` of `utils.sqlite_profiles`.
+    """
+    engine = create_sqlite_engine(target_db_path, profile)
+    Base.metadata.create_all(engine)
+
+    dependencies = get_class_dependencies()
+    sorted_tables = topo_sort_classes(dependencies)
+    logger.info("Topologically sorted classes: %s", sorted_tables)
+
+    name_to_class = {cls.__tablename__: cls for cls in all_classes}
+
+    source_hash = file_hash(source_db_path)
+
+    with engine.connect() as conn:
+        merged_tables = load_journal(conn, source_hash)
+        conn.commit()
+        conflict_report = create_conflict_report(
+            conflicts, source_db_path, lambda: conn
+        )
+        conn.exec_driver_sql("ATTACH DATABASE ? AS src", (source_db_path,))
+        for table_name in sorted_tables:
+            if table_name in merged_tables:
+                logger.info(
+                    f"Skipping table already merged from this source: {table_name}"
+                )
+                create_map_table(conn, table_name, merged_tables[table_name])
+                continue
+
+            merge_table_sql(conn, name_to_class[table_name], conflict_report)
+            record_journal(
+                conn,
+                source_db_path,
+                source_hash,
+                table_name,
+                read_map_table(conn, table_name),
+            )
+            if conflict_report is not None:
+                conflict_report.flush()
+            conn.commit()
+            if conflict_report is not None:
+                conflict_report.commit()
+
+        for table_name in sorted_tables:
+            conn.exec_driver_sql(f"DROP TABLE temp.{quote('map_' + table_name)}")
+        conn.exec_driver_sql("DETACH DATABASE src")
+    engine.dispose()
+    reset_journal_mode(target_db_path, profile)
+
+
+def count_rows(conn: Connection, schema: str, table_name: str) -> int:
+    return conn.exec_driver_sql(
+        f"SELECT COUNT(*) FROM {schema}.{quote(table_name)}"
+    ).scalar()
+
+
+def merge_table_sql(
+    conn: Connection,
+    model_cls: Type[Base],
+    conflicts: Optional[ConflictReport] = None,
+    schema: str = "src",
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """Merge the rows of `src.<table>` into `main.<table>` for a given model class.
+
+    With `dry_run`, differing matches are only counted, not reported, so that the
+    merge can be rolled back to plan it (see `merge_plan.py`).
+
+    Pre-conditions:
+      - The source database is attached to `conn` as `src`, or as `schema`.
+      - The tables corresponding to model_cls must exist in both databases.
+      - Any foreign key relationships in model_cls must correspond to tables that
+        have already been merged, i.e. that have a `temp.map_<table>` table.
+
+    Post-conditions:
+      - `temp.map_<table>(old_id, new_id)` maps every source id to its target id.
+
+    Returns:
+      The number of source rows that were inserted, matched to existing rows, matched
+      to inserted rows of the same source (duplicates), and matched with different
+      values (conflicts).
+    """
+    table_name = model_cls.__tablename__
+    table = quote(table_name)
+    columns = model_cls.non_pk_columns()
+    names = [quote(c.name) for c in columns]
+
+    logger.info(f"Merging table: {table_name}")
+    logger.info(f"# Records in target db: {count_rows(conn, 'main', table_name)}")
+    logger.info(f"# Records in source db: {count_rows(conn, schema, table_name)}")
+
+    create_remapped_source(conn, model_cls, schema)
+    match_target_rows(conn, model_cls)
+    match_source_duplicates(conn, model_cls)
+
+    # Assign the next ids in source order, exactly as row-by-row ORM inserts would
+    conn.exec_driver_sql(f"""
+        UPDATE temp.merge_src SET new_id = ranked.new_id
+        FROM (
+            SELECT old_id,
+                   (SELECT COALESCE(MAX(id), 0) FROM main.{table})
+                   + ROW_NUMBER() OVER (ORDER BY old_id) AS new_id
+            FROM temp.merge_src WHERE state = {INSERTED}
+        ) AS ranked
+        WHERE merge_src.old_id = ranked.old_id
+        """)
+    conn.exec_driver_sql(f"""
+        INSERT INTO main.{table} (id, {", ".join(names)})
+        SELECT new_id, {", ".join(names)} FROM temp.merge_src
+        WHERE state = {INSERTED} ORDER BY old_id
+        """)
+    if model_cls is PacketQuestion:
+        # Inserted with plain SQL, so the ORM checks do not see these rows
+        merge_src = sqlalchemy.table(
+            "merge_src",
+            sqlalchemy.column("new_id"),
+            sqlalchemy.column("state"),
+            schema="temp",
+        )
+        check_packet_questions(
+            conn,
+            PacketQuestion.id.in_(
+                sqlalchemy.select(merge_src.c.new_id).where(
+                    merge_src.c.state == INSERTED
+                )
+            ),
+        )
+    conn.exec_driver_sql(f"""
+        UPDATE temp.merge_src SET new_id = dup.new_id
+        FROM temp.merge_src AS dup
+        WHERE merge_src.state = {DUPLICATE} AND dup.old_id = merge_src.dup_of
+        """)
+
+    counts = dict(
+        conn.exec_driver_sql(
+            "SELECT state, COUNT(*) FROM temp.merge_src GROUP BY state"
+        ).fetchall()
+    )
+    pairs = conflict_pairs(conn, model_cls)
+    if not dry_run:
+        log_conflicts(conn, model_cls, pairs, conflicts)
+
+    create_map_table(conn, table_name)
+    conn.exec_driver_sql(
+        f"INSERT INTO temp.{quote('map_' + table_name)} "
+        "SELECT old_id, new_id FROM temp.merge_src"
+    )
+    conn.exec_driver_sql("DROP TABLE temp.merge_src")
+    conn.exec_driver_sql("DROP TABLE IF EXISTS temp.merge_dup_edge")
+
+    logger.info(f"# Records in target db: {count_rows(conn, 'main', table_name)}")
+    return {
+        "inserted": counts.get(INSERTED, 0),
+        "matched": counts.get(MATCHED, 0),
+        "duplicates": counts.get(DUPLICATE, 0),
+        "conflicts": len(pairs),
+    }
+
+
+def create_map_table(
+    conn: Connection, table_name: str, id_mapping: Optional[IdMapping] = None
+) -> None:
+    """
+    Create the `temp.map_<table>(old_id, new_id)` table, filled from `id_mapping` if given.
+    """
+    map_table = quote(f"map_{table_name}")
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS temp.{map_table}")
+    conn.exec_driver_sql(
+        f"CREATE TEMP TABLE {map_table} (old_id INTEGER PRIMARY KEY, new_id INTEGER)"
+    )
+    if id_mapping is not None and len(id_mapping):
+        conn.exec_driver_sql(
+            f"INSERT INTO temp.{map_table} VALUES (?, ?)", list(id_mapping.items())
+        )
+
+
+def read_map_table(conn: Connection, table_name: str) -> IdMapping:
+    rows = conn.exec_driver_sql(
+        f"SELECT old_id, new_id FROM temp.{quote('map_' + table_name)}"
+    ).fetchall()
+    return IdMapping([row[0] for row in rows], [row[1] for row in rows])
+
+
+def create_remapped_source(
+    conn: Connection, model_cls: Type[Base], schema: str = "src"
+) -> None:
+    """
+    Copy the source rows of `model_cls` in `schema` to `temp.merge_src`, with their
+    foreign keys translated to target ids and their `models.DERIVED_COLUMNS` derived
+    where they are missing.
+    """
+    table = quote(model_cls.__tablename__)
+    select_columns, joins, unmapped = [], [], []
+    derived = derived_column_queries(conn, model_cls, schema)
+    for col in model_cls.non_pk_columns():
+        if col.name in derived:
+            derived_alias = quote(f"d_{col.name}")
+            joins.append(
+                f"LEFT JOIN ({derived[col.name]}) {derived_alias} "
+                f"ON {derived_alias}.id = s.id"
+            )
+            value = f"{derived_alias}.value"
+        else:
+            value = f"s.{quote(col.name)}"
+        if not col.foreign_keys:
+            select_columns.append(f"{value} AS {quote(col.name)}")
+            continue
+        assert len(col.foreign_keys) == 1, (
+            "Expected 1 foreign key, got composite foreign key of length "
+            f"{len(col.foreign_keys)} for column {col.name}"
+        )
+        fk = list(col.foreign_keys)[0]
+        alias = quote(f"m_{col.name}")
+        map_table = quote(f"map_{fk.column.table.name}")
+        joins.append(f"LEFT JOIN temp.{map_table} {alias} ON {alias}.old_id = {value}")
+        select_columns.append(f"{alias}.new_id AS {quote(col.name)}")
+        unmapped.append(f"({value} IS NOT NULL AND {alias}.new_id IS NULL)")
+
+    conn.exec_driver_sql("DROP TABLE IF EXISTS temp.merge_src")
+    conn.exec_driver_sql(f"""
+        CREATE TEMP TABLE merge_src AS
+        SELECT s.id AS old_id, NULL AS new_id, {UNDECIDED} AS state, NULL AS dup_of,
+               {", ".join(select_columns)}
+        FROM {schema}.{table} s {" ".join(joins)}
+        """)
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX temp.merge_src_old_id ON merge_src (old_id)"
+    )
+
+    if unmapped:
+        missing = conn.exec_driver_sql(
+            f"SELECT s.id FROM {schema}.{table} s {' '.join(joins)} "
+            f"WHERE {' OR '.join(unmapped)} LIMIT 1"
+        ).scalar()
+        if missing is not None:
+            raise KeyError(
+                f"Record {missing} of {model_cls.__tablename__} references a record "
+                "that was not merged"
+            )
+
+
+def null_patterns(conn: Connection, model_cls: Type[Base], state: int) -> List[list]:
+    """
+    List the distinct subsets of unique columns that are non-NULL in the rows of
+    `temp.merge_src` with the given state.
+    """
+    unique_columns = get_unique_columns(model_cls)
+    flags = ", ".join(f"{quote(c.name)} IS NOT NULL" for c in unique_columns)
+    rows = conn.exec_driver_sql(
+        f"SELECT DISTINCT {flags} FROM temp.merge_src WHERE state = {state}"
+    ).fetchall()
+    return [[c for c, flag in zip(unique_columns, row) if flag] for row in rows]
+
+
+def pattern_condition(model_cls: Type[Base], non_null: list, alias: str) -> str:
+    """SQL condition selecting the rows of `alias` with exactly this NULL pattern."""
+    non_null_keys = {c.key for c in non_null}
+    conditions = [
+        f"{alias}.{quote(c.name)} IS {'NOT ' if c.key in non_null_keys else ''}NULL"
+        for c in get_unique_columns(model_cls)
+    ]
+    return " AND ".join(conditions) or "1"
+
+
+def equality_condition(non_null: list, left: str, right: str) -> str:
+    conditions = [f"{left}.{quote(c.name)} = {right}.{quote(c.name)}" for c in non_null]
+    return " AND ".join(conditions) or "1"
+
+
+def match_target_rows(conn: Connection, model_cls: Type[Base]) -> None:
+    """
+    Map the rows of `temp.merge_src` that match an existing target row to the lowest
+    such target id, like `merge_db.record_exists`.
+    """
+    table = quote(model_cls.__tablename__)
+    for non_null in null_patterns(conn, model_cls, UNDECIDED):
+        conn.exec_driver_sql(f"""
+            UPDATE temp.merge_src SET new_id = matched.new_id, state = {MATCHED}
+            FROM (
+                SELECT s.old_id AS old_id, MIN(t.id) AS new_id
+                FROM temp.merge_src s JOIN main.{table} t
+                    ON {equality_condition(non_null, "s", "t")}
+                WHERE {pattern_condition(model_cls, non_null, "s")}
+                GROUP BY s.old_id
+            ) AS matched
+            WHERE merge_src.old_id = matched.old_id
+            """)
+
+
+def match_source_duplicates(conn: Connection, model_cls: Type[Base]) -> None:
+    """
+    Decide which unmatched rows of `temp.merge_src` are inserted.
+
+    Inserting row by row, a row is mapped to the first earlier inserted row it matches,
+    and inserted if there is none. Whether an earlier row is inserted depends on the
+    rows before it, so rows are decided in rounds: a row is inserted once none of the
+    earlier rows it matches can still be inserted, and is a duplicate once the first of
+    them is inserted. Each round decides at least the first undecided row.
+    """
+    conn.exec_driver_sql(
+        "CREATE TEMP TABLE merge_dup_edge (old_id INTEGER, earlier_id INTEGER)"
+    )
+    for non_null in null_patterns(conn, model_cls, UNDECIDED):
+        conn.exec_driver_sql(f"""
+            INSERT INTO temp.merge_dup_edge
+            SELECT s.old_id, e.old_id
+            FROM temp.merge_src s JOIN temp.merge_src e
+                ON {equality_condition(non_null, "s", "e")} AND e.old_id < s.old_id
+            WHERE s.state = {UNDECIDED} AND e.state = {UNDECIDED}
+                AND {pattern_condition(model_cls, non_null, "s")}
+            """)
+    conn.exec_driver_sql(
+        "CREATE INDEX temp.merge_dup_edge_old_id ON merge_dup_edge (old_id)"
+    )
+
+    undecided = conn.exec_driver_sql(
+        f"SELECT COUNT(*) FROM temp.merge_src WHERE state = {UNDECIDED}"
+    ).scalar()
+    while undecided:
+        # First earlier row that is inserted or may still be inserted
+        first_candidate = f"""
+            SELECT MIN(e.earlier_id) FROM temp.merge_dup_edge e
+            JOIN temp.merge_src c ON c.old_id = e.earlier_id
+            WHERE e.old_id = merge_src.old_id AND c.state IN ({UNDECIDED}, {INSERTED})
+        """
+        decided = conn.exec_driver_sql(f"""
+            UPDATE temp.merge_src SET state = {INSERTED}
+            WHERE state = {UNDECIDED} AND ({first_candidate}) IS NULL
+            """).rowcount
+        decided += conn.exec_driver_sql(f"""
+            UPDATE temp.merge_src SET state = {DUPLICATE}, dup_of = ({first_candidate})
+            WHERE state = {UNDECIDED} AND (
+                SELECT c.state FROM temp.merge_src c WHERE c.old_id = ({first_candidate})
+            ) = {INSERTED}
+            """).rowcount
+        assert decided > 0, "Could not resolve duplicate source records"
+        undecided -= decided
+
+
+def conflict_pairs(conn: Connection, model_cls: Type[Base]) -> list:
+    """
+    List the (old_id, new_id) of the source rows that were mapped to an existing row
+    with different values.
+    """
+    table = quote(model_cls.__tablename__)
+    differs = " OR ".join(
+        f"s.{quote(c.name)} IS NOT t.{quote(c.name)}"
+        for c in model_cls.non_pk_columns()
+    )
+    return conn.exec_driver_sql(f"""
+        SELECT s.old_id, s.new_id FROM temp.merge_src s
+        JOIN main.{table} t ON t.id = s.new_id
+        WHERE s.state IN ({MATCHED}, {DUPLICATE}) AND ({differs})
+        ORDER BY s.old_id
+        """).fetchall()
+
+
+def log_conflicts(
+    conn: Connection,
+    model_cls: Type[Base],
+    pairs: list,
+    conflicts: Optional[ConflictReport] = None,
+) -> None:
+    """
+    Report the differing fields of the `conflict_pairs` of source and existing rows,
+    in the same format as `merge_db.merge_table`.
+    """
+    table = quote(model_cls.__tablename__)
+
+    for start in range(0, len(pairs), MAX_VARIABLES):
+        batch = pairs[start : start + MAX_VARIABLES]
+        new_records = load_records(
+            conn, model_cls, "temp.merge_src", "old_id", [p[0] for p in batch]
+        )
+        existing_records = load_records(
+            conn, model_cls, f"main.{table}", "id", [p[1] for p in batch]
+        )
+        for old_id, new_id in batch:
+            diff_dict = create_diff_dict(
+                model_cls, existing_records[new_id], new_records[old_id]
+            )
+            if diff_dict:
+                report_conflict(
+                    conflicts, model_cls.__tablename__, old_id, new_id, diff_dict
+                )
+
+
+def load_records(
+    conn: Connection, model_cls: Type[Base], source: str, id_column: str, ids: list
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Load the non-PK values of rows of `source` by column key, keyed by `id_column`,
+    converting the stored values with the column types of the model.
+    """
+    columns = model_cls.non_pk_columns()
+    placeholders = ", ".join(f":id_{i}" for i in range(len(ids)))
+    stmt = sqlalchemy.text(
+        f"SELECT {id_column} AS key_id, {', '.join(quote(c.name) for c in columns)} "
+        f"FROM {source} WHERE {id_column} IN ({placeholders})"
+    ).columns(
+        sqlalchemy.column("key_id", sqlalchemy.Integer),
+        *[sqlalchemy.column(c.name, c.type) for c in columns],
+    )
+    rows = conn.execute(stmt, {f"id_{i}": v for i, v in enumerate(ids)})
+    return {row.key_id: {c.key: row._mapping[c.name] for c in columns} for row in rows}
@@ -0,0 +1,332 @@
+"""
+Parallel tree-reduction merge of many source databases.
+
+Instead of merging every source one after another into a single, ever-growing target,
+the sources are merged in pairs by a process pool into intermediate databases, which
+are then merged in pairs again, and so on until a single database remains.
+
+Sources are always paired in the given order and each pair is merged left then right,
+so the final ids only depend on the order of the sources, not on scheduling. The logs
+of all the merges, including their conflicts, are collected into a single log file.
+Conflicts reported to a JSONL file or to the `merge_conflict` table are collected into
+the final JSONL file or database, translated by `ConflictTranslator` so that they refer
+to the original sources and to the ids of the final database.
+
+Intermediate databases are kept in `<output.db>.parts/` until the merge is done, so an
+interrupted merge can be resumed with `--resume`.
+
+Example usage:
+    python merge_db.py -i <input1.db> [<input2.db> ...] -o <output.db> --parallel 4
+"""
+
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import sqlalchemy
+from loguru import logger
+from sqlalchemy import create_engine
+
+from merge_db import (
+    IdMapping,
+    file_hash,
+    journal_metadata,
+    merge_conflict,
+    merge_databases,
+    merge_journal,
+)
+
+
+def merge_sources(
+    src_db_paths: List[str], target_db_path: str, engine: str = "orm", **merge_kwargs
+) -> None:
+    """
+    Merge the source databases one after another into the target database.
+
+    :param engine: "orm" for `merge_db.merge_databases`, which gets `merge_kwargs`, or
+        "sql" for `merge_sql.merge_databases_sql`, which only gets `conflicts` and
+        `profile`
+    """
+    for src_db_path in src_db_paths:
+        if engine == "sql":
+            from merge_sql import merge_databases_sql
+
+            merge_databases_sql(
+                src_db_path,
+                target_db_path,
+                merge_kwargs.get("conflicts"),
+                merge_kwargs.get("profile", "default"),
+            )
+        else:
+            merge_databases(src_db_path, target_db_path, **merge_kwargs)
+
+
+def merge_group(
+    src_db_paths: List[str],
+    target_db_path: str,
+    log_path: str,
+    engine: str = "orm",
+    **merge_kwargs,
+) -> str:
+    """
+    Merge a group of sources into an intermediate database in a worker process,
+    logging to `log_path` only.
+    """
+    logger.remove()
+    sink_id = logger.add(log_path, mode="w")
+    try:
+        merge_sources(src_db_paths, target_db_path, engine, **merge_kwargs)
+    finally:
+        logger.remove(sink_id)
+    return target_db_path
+
+
+class ConflictTranslator:
+    """
+    Translates the conflicts reported by the merges of a tree to the final database.
+
+    A conflict reported by a merge refers to the source of that merge, which may be an
+    intermediate database, and to a target id in its output, which is merged again at
+    later levels. Target ids are translated through the `merge_journal` id mappings
+    of the later merges, and the records of intermediate sources are traced back,
+    through their own journals, to the first original source they were merged from.
+
+    :param merges: (sources, output) of every merge of the tree
+    """
+
+    def __init__(self, merges: List[Tuple[List[str], str]], target_db_path: str):
+        self.target_db_path = os.path.abspath(target_db_path)
+        # Output of the merge of each source and intermediate database
+        self.merged_into = {
+            os.path.abspath(src_db_path): os.path.abspath(output)
+            for group, output in merges
+            for src_db_path in group
+        }
+        self.parts = {os.path.abspath(output) for _, output in merges} - {
+            self.target_db_path
+        }
+        self.journals = {}
+        self.hashes = {}
+
+    def journal(self, db_path: str) -> List[Tuple[str, str, str, IdMapping]]:
+        """(source hash, source path, table, id mapping) of a db, in merge order."""
+        if db_path not in self.journals:
+            engine = create_engine(f"sqlite:///{db_path}")
+            with engine.connect() as conn:
+                rows = conn.execute(
+                    sqlalchemy.select(
+                        merge_journal.c.source_hash,
+                        merge_journal.c.source_path,
+                        merge_journal.c.table_name,
+                        merge_journal.c.id_mapping,
+                    ).order_by(merge_journal.c.merged_at)
+                ).fetchall()
+            engine.dispose()
+            self.journals[db_path] = [
+                (row[0], row[1], row[2], IdMapping.from_bytes(row[3])) for row in rows
+            ]
+        return self.journals[db_path]
+
+    def target_id(self, db_path: str, table_name: str, target_id: int) -> int:
+        """Final id of the record `target_id` of an intermediate database."""
+        while db_path != self.target_db_path:
+            next_db_path = self.merged_into[db_path]
+            if db_path not in self.hashes:
+                self.hashes[db_path] = file_hash(db_path)
+            # Looked up by hash, as the journal does, in case of identical sources
+            id_mapping = next(
+                id_mapping
+                for source_hash, _, name, id_mapping in self.journal(next_db_path)
+                if source_hash == self.hashes[db_path] and name == table_name
+            )
+            target_id = id_mapping[target_id]
+            db_path = next_db_path
+        return target_id
+
+    def source(
+        self, source_path: str, table_name: str, source_id: int
+    ) -> Tuple[str, int]:
+        """Original source path and id of a record of a source of a merge."""
+        while source_path in self.parts:
+            for _, path, name, id_mapping in self.journal(source_path):
+                if name != table_name:
+                    continue
+                old_ids, new_ids = id_mapping.arrays()
+                positions = np.flatnonzero(new_ids == source_id)
+                if len(positions):
+                    source_path, source_id = path, int(old_ids[positions[0]])
+                    break
+            else:
+                break
+        return source_path, source_id
+
+    def translate(self, row: Dict[str, Any], db_path: str) -> Dict[str, Any]:
+        """A conflict row reported to the merge whose output is `db_path`."""
+        row = dict(row)
+        row["source_path"], row["source_id"] = self.source(
+            row["source_path"], row["table_name"], row["source_id"]
+        )
+        row["target_id"] = self.target_id(
+            os.path.abspath(db_path), row["table_name"], row["target_id"]
+        )
+        return row
+
+
+def collect_conflict_tables(
+    part_db_paths: List[str], target_db_path: str, translator: ConflictTranslator
+) -> None:
+    """
+    Copy the `merge_conflict` rows of intermediate databases to the target database,
+    and translate the rows of the target database reported by the last merge.
+    """
+    columns = [c.name for c in merge_conflict.c if c.name != "id"]
+    engine = create_engine(f"sqlite:///{target_db_path}")
+    with engine.connect() as conn:
+        journal_metadata.create_all(conn)
+        rows = conn.execute(
+            sqlalchemy.select(merge_conflict).where(
+                merge_conflict.c.source_path.in_(translator.parts)
+            )
+        ).fetchall()
+        for row in rows:
+            translated = translator.translate(row._asdict(), target_db_path)
+            conn.execute(
+                merge_conflict.update()
+                .where(merge_conflict.c.id == row.id)
+                .values(
+                    source_path=translated["source_path"],
+                    source_id=translated["source_id"],
+                )
+            )
+        conn.commit()
+
+        for part_db_path in part_db_paths:
+            part_engine = create_engine(f"sqlite:///{part_db_path}")
+            with part_engine.connect() as part_conn:
+                journal_metadata.create_all(part_conn)
+                rows = part_conn.execute(
+                    sqlalchemy.select(*[merge_conflict.c[name] for name in columns])
+                ).fetchall()
+            part_engine.dispose()
+            translated = [
+                translator.translate(row._asdict(), part_db_path) for row in rows
+            ]
+            if translated:
+                conn.execute(merge_conflict.insert(), translated)
+            conn.commit()
+    engine.dispose()
+
+
+def collect_conflict_files(
+    merges: List[Tuple[str, str]], conflicts_path: str, translator: ConflictTranslator
+) -> None:
+    """
+    Append the translated rows of the JSONL conflict files of the merges, given as
+    (output, conflicts file), to `conflicts_path`.
+    """
+    with open(conflicts_path, "a") as conflicts_file:
+        for output, group_conflicts_path in merges:
+            if not os.path.exists(group_conflicts_path):
+                continue
+            with open(group_conflicts_path) as f:
+                for line in f:
+                    row = translator.translate(json.loads(line), output)
+                    conflicts_file.write(json.dumps(row, default=str) + "\n")
+
+
+def merge_tree(
+    src_db_paths: List[str],
+    target_db_path: str,
+    processes: int,
+    log_path: str,
+    engine: str = "orm",
+    resume: bool = False,
+    **merge_kwargs,
+) -> None:
+    """
+    Merge the source databases into the target database by pairwise tree reduction.
+
+    :param processes: Number of worker processes
+    :param log_path: File collecting the logs of all the merges
+    :param engine: Merge engine, see `merge_sources`
+    :param resume: Keep existing intermediate databases and resume their merges
+    """
+    conflicts = merge_kwargs.get("conflicts")
+    parts_dir = f"{target_db_path}.parts"
+    os.makedirs(parts_dir, exist_ok=True)
+
+    paths = list(src_db_paths)
+    merges = []
+    level = 0
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        while level == 0 or len(paths) > 1:
+            groups = [paths[i : i + 2] for i in range(0, len(paths), 2)]
+            is_last_level = len(groups) == 1
+            futures, next_paths = [], []
+            for i, group in enumerate(groups):
+                if len(group) == 1 and not is_last_level:
+                    # Odd one out, merged at a later level
+                    next_paths.append(group[0])
+                    continue
+
+                if is_last_level:
+                    output = target_db_path
+                else:
+                    output = os.path.join(parts_dir, f"level{level}_{i}.db")
+                    if os.path.exists(output) and not resume:
+                        os.remove(output)
+                group_log_path = os.path.join(parts_dir, f"level{level}_{i}.log")
+                group_kwargs = dict(merge_kwargs)
+                if conflicts not in (None, "db"):
+                    group_kwargs["conflicts"] = os.path.join(
+                        parts_dir, f"level{level}_{i}.conflicts.jsonl"
+                    )
+                    if os.path.exists(group_kwargs["conflicts"]) and not resume:
+                        os.remove(group_kwargs["conflicts"])
+                logger.info(f"Merging {group} -> {output}")
+                futures.append(
+                    pool.submit(
+                        merge_group,
+                        group,
+                        output,
+                        group_log_path,
+                        engine,
+                        **group_kwargs,
+                    )
+                )
+                next_paths.append(output)
+                merges.append(
+                    (group, output, group_log_path, group_kwargs.get("conflicts"))
+                )
+
+            for future in futures:
+                future.result()
+            paths = next_paths
+            level += 1
+
+    with open(log_path, "w") as log_file:
+        for group, output, group_log_path, _ in merges:
+            log_file.write(f"# Merge of {', '.join(group)} -> {output}\n")
+            with open(group_log_path) as f:
+                shutil.copyfileobj(f, log_file)
+    logger.info(f"Merge logs collected in {log_path}")
+
+    translator = ConflictTranslator(
+        [(group, output) for group, output, _, _ in merges], target_db_path
+    )
+    if conflicts == "db":
+        collect_conflict_tables(
+            [output for _, output, _, _ in merges if output != target_db_path],
+            target_db_path,
+            translator,
+        )
+    elif conflicts is not None:
+        collect_conflict_files(
+            [(output, path) for _, output, _, path in merges], conflicts, translator
+        )
+        logger.info(f"Merge conflicts collected in {conflicts}")
+
+    shutil.rmtree(parts_dir)
@@ -0,0 +1,217 @@
+"""
+Versioned schema migrations for the databases of `models.Base.metadata`.
+
+Each database records the migrations applied to it in its `schema_version` table.
+`upgrade` applies the pending `MIGRATIONS` in order, each in a single transaction
+together with its version row, so an interrupted upgrade restarts at the first
+migration that did not finish. Data backfills run as set-based SQL over batches of
+ids, with their progress logged.
+
+To change the schema, add the column to `models.py` and append a migration that adds it
+to existing databases and backfills it.
+
+Example usage:
+    python migrate.py data/sst-23-24-cleaned.db data/nats24.db
+"""
+
+import argparse
+from datetime import datetime
+from typing import Callable, NamedTuple, Optional
+
+import sqlalchemy
+from loguru import logger
+from sqlalchemy.engine import Connection
+
+from models import (
+    DERIVED_COLUMNS,
+    Base,
+    create_missing_indexes,
+    create_transactional_engine,
+)
+from utils.sqlite_profiles import WRITE_PROFILES, reset_journal_mode
+
+version_metadata = sqlalchemy.MetaData()
+
+schema_version = sqlalchemy.Table(
+    "schema_version",
+    version_metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("description", sqlalchemy.String),
+    sqlalchemy.Column("applied_at", sqlalchemy.DateTime),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    # Applies the migration on a connection in a transaction, given the batch size
+    upgrade: Callable[[Connection, int], None]
+
+
+def column_exists(conn: Connection, table_name: str, column_name: str) -> bool:
+    rows = conn.exec_driver_sql(f'PRAGMA table_info("{table_name}")').fetchall()
+    return any(row[1] == column_name for row in rows)
+
+
+def add_model_column(conn: Connection, table_name: str, column_name: str) -> None:
+    """Add a column of `models.Base.metadata` to its table, if it is missing."""
+    if column_exists(conn, table_name, column_name):
+        logger.info(f"Column {column_name} already exists in table {table_name}")
+        return
+    column = Base.metadata.tables[table_name].c[column_name]
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.exec_driver_sql(
+        f'ALTER TABLE "{table_name}" ADD COLUMN "{column_name}" {column_type}'
+    )
+
+
+def backfill(
+    conn: Connection,
+    table_name: str,
+    column_name: str,
+    values_query: str,
+    batch_size: int,
+) -> int:
+    """
+    Set the NULL values of a column from a query of (id, value), one batch of ids at a
+    time. The query is run once into a temp table, so each batch is a cheap join.
+
+    :return: Number of updated rows
+    """
+    table, column = f'"{table_name}"', f'"{column_name}"'
+    conn.exec_driver_sql("DROP TABLE IF EXISTS temp.backfill")
+    conn.exec_driver_sql("CREATE TEMP TABLE backfill (id INTEGER PRIMARY KEY, value)")
+    conn.exec_driver_sql(f"INSERT INTO temp.backfill {values_query}")
+
+    first_id, last_id = conn.exec_driver_sql(
+        f"SELECT MIN(id), MAX(id) FROM {table}"
+    ).one()
+    updated = 0
+    if first_id is not None:
+        for start in range(first_id, last_id + 1, batch_size):
+            end = min(start + batch_size - 1, last_id)
+            updated += conn.exec_driver_sql(
+                f"UPDATE {table} SET {column} = b.value FROM temp.backfill b "
+                f"WHERE {table}.id = b.id AND {table}.{column} IS NULL "
+                f"AND b.id BETWEEN ? AND ?",
+                (start, end),
+            ).rowcount
+            progress = (end - first_id + 1) / (last_id - first_id + 1)
+            logger.info(
+                f"Backfilling {table_name}.{column_name}: {progress:.0%} "
+                f"({updated} rows updated)"
+            )
+    conn.exec_driver_sql("DROP TABLE temp.backfill")
+    return updated
+
+
+def create_tables(conn: Connection, batch_size: int) -> None:
+    Base.metadata.create_all(conn)
+
+
+def add_question_set_edition_id(conn: Connection, batch_size: int) -> None:
+    add_model_column(conn, "question", "question_set_edition_id")
+    derivation = DERIVED_COLUMNS["question"]["question_set_edition_id"].format(
+        schema="main"
+    )
+    # Questions whose packets belong to several editions are left NULL
+    backfill(
+        conn,
+        "question",
+        "question_set_edition_id",
+        f"SELECT id, value FROM ({derivation}) WHERE n_values = 1",
+        batch_size,
+    )
+
+
+def add_indexes(conn: Connection, batch_size: int) -> None:
+    created, skipped = create_missing_indexes(conn)
+    logger.info(f"Created indexes: {created}")
+    if skipped:
+        logger.warning(f"Skipped indexes on missing tables or columns: {skipped}")
+    conn.exec_driver_sql("ANALYZE")
+
+
+# Ordered by version; never edit or reorder applied migrations, append new ones
+MIGRATIONS = [
+    Migration(1, "Create missing tables", create_tables),
+    Migration(
+        2,
+        "Add question.question_set_edition_id from the packets of each question",
+        add_question_set_edition_id,
+    ),
+    Migration(3, "Add the foreign key and covering indexes", add_indexes),
+]
+
+
+def current_version(conn: Connection) -> int:
+    version_metadata.create_all(conn)
+    version = conn.execute(
+        sqlalchemy.select(sqlalchemy.func.max(schema_version.c.version))
+    ).scalar()
+    return version or 0
+
+
+def upgrade(
+    db_path: str,
+    batch_size: int = 50000,
+    target_version: Optional[int] = None,
+    profile: str = "default",
+) -> int:
+    """
+    Apply the pending migrations of a database, up to `target_version` if given, with
+    the connection `profile` of `utils.sqlite_profiles`.
+
+    :return: The schema version of the database
+    """
+    engine = create_transactional_engine(db_path, profile)
+    with engine.connect() as conn:
+        with conn.begin():
+            version = current_version(conn)
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+            if target_version is not None and migration.version > target_version:
+                break
+            logger.info(
+                f"{db_path}: Migrating to version {migration.version}: "
+                f"{migration.description}"
+            )
+            with conn.begin():
+                migration.upgrade(conn, batch_size)
+                conn.execute(
+                    schema_version.insert().values(
+                        version=migration.version,
+                        description=migration.description,
+                        applied_at=datetime.now(),
+                    )
+                )
+            version = migration.version
+    engine.dispose()
+    reset_journal_mode(db_path, profile)
+    logger.info(f"{db_path}: Schema version {version}")
+    return version
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upgrade the schema of databases.")
+    parser.add_argument("db_paths", nargs="+", help="Paths to the databases")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=50000,
+        help="Number of ids per batch of the data backfills",
+    )
+    parser.add_argument(
+        "--target_version", type=int, help="Stop after this version (default: latest)"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=WRITE_PROFILES,
+        default="default",
+        help="SQLite connection profile, see utils/sqlite_profiles.py",
+    )
+    args = parser.parse_args()
+
+    for db_path in args.db_paths:
+        upgrade(db_path, args.batch_size, args.target_version, args.profile)
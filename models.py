@@ -1,36 +1,207 @@
+import atexit
+import datetime
+import os
+import threading
+from functools import lru_cache
+from operator import attrgetter, itemgetter
+from typing import Optional
+
+import msgspec
 from sqlalchemy import (
     Boolean,
     Column,
     Date,
     ForeignKey,
+    Index,
     Integer,
     String,
     UniqueConstraint,
+    and_,
     create_engine,
     event,
+    false,
+    or_,
+    select,
 )
-from sqlalchemy.orm import DeclarativeBase, Session, relationship, sessionmaker
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Session,
+    aliased,
+    joinedload,
+    relationship,
+    selectinload,
+    sessionmaker,
+)
+
+from utils.sqlite_profiles import apply_profile, sqlalchemy_url
 
+# Max number of values bound in a single `IN (...)` clause
+MAX_VARIABLES = 500
 
-def validate_packet_question(mapper, connection, target):
-    session = Session.object_session(target)
-    question = session.query(Question).filter_by(id=target.question_id).one()
-    packet = session.query(Packet).filter_by(id=target.packet_id).one()
 
-    if question.question_set_edition_id != packet.question_set_edition_id:
+def check_packet_questions(connection, condition) -> None:
+    """
+    Raise a ValueError if the question and packet of a PacketQuestion matching
+    `condition` belong to different question_set_editions, with a single join.
+
+    `connection` is a Session or Connection, so that rows inserted with Core
+    statements, which the ORM events never see, are checked as well.
+    """
+    invalid = connection.execute(
+        select(PacketQuestion.question_id, PacketQuestion.packet_id)
+        .outerjoin(Question, Question.id == PacketQuestion.question_id)
+        .outerjoin(Packet, Packet.id == PacketQuestion.packet_id)
+        .where(
+            condition,
+            or_(
+                Question.id.is_(None),
+                Packet.id.is_(None),
+                Question.question_set_edition_id.is_distinct_from(
+                    Packet.question_set_edition_id
+                ),
+            ),
+        )
+        .limit(1)
+    ).first()
+    if invalid is not None:
         raise ValueError(
-            f"Question {question.id} is associated with a different question_set_edition "
-            f"than Packet {packet.id}"
+            f"Question {invalid.question_id} is associated with a different "
+            f"question_set_edition than Packet {invalid.packet_id}"
         )
 
 
-def to_dict(obj):
-    excl = ("_sa_adapter", "_sa_instance_state")
-    return {
-        k: v
-        for k, v in vars(obj).items()
-        if not k.startswith("_") and not any(hasattr(v, a) for a in excl)
-    }
+def check_packet_question_ids(connection, ids) -> None:
+    """`check_packet_questions` for PacketQuestion ids, one join per batch of ids."""
+    ids = list(ids)
+    for start in range(0, len(ids), MAX_VARIABLES):
+        batch = ids[start : start + MAX_VARIABLES]
+        check_packet_questions(connection, PacketQuestion.id.in_(batch))
+
+
+def validate_packet_questions(session, flush_context):
+    """
+    Check that the question and packet of every inserted or updated PacketQuestion
+    belong to the same question_set_edition.
+
+    Runs after each flush, so that the rows of the flush are visible, and raising
+    rolls the flush back.
+    """
+    check_packet_question_ids(
+        session,
+        [
+            obj.id
+            for obj in session.new | session.dirty
+            if isinstance(obj, PacketQuestion)
+            and (obj in session.new or session.is_modified(obj))
+        ],
+    )
+
+
+def column_python_type(column) -> type:
+    """Python type of the values of a column."""
+    if isinstance(column.type, Boolean):
+        return bool
+    if isinstance(column.type, Integer):
+        return int
+    if isinstance(column.type, Date):
+        return datetime.date
+    return str
+
+
+def tuple_getter(keys):
+    """
+    Getter of the values of several attributes of a record, as a tuple. The values are
+    read from the `__dict__` of the record, which is several times faster than going
+    through the ORM attributes, unless some of them are not loaded.
+    """
+    if len(keys) == 1:
+        key, getter = keys[0], attrgetter(keys[0])
+        fast_getter = lambda state: (state[key],)  # noqa: E731
+        slow_getter = lambda record: (getter(record),)  # noqa: E731
+    else:
+        fast_getter, slow_getter = itemgetter(*keys), attrgetter(*keys)
+
+    def get(record):
+        try:
+            return fast_getter(record.__dict__)
+        except KeyError:
+            return slow_getter(record)
+
+    return get
+
+
+class Serializer:
+    """
+    Serializer of the records of a model, compiled once from the columns of its table
+    by `get_serializer`, to turn whole batches of records into tuples, dicts or frozen
+    msgspec structs.
+    """
+
+    def __init__(self, model_cls):
+        table = model_cls.__table__
+        self.keys = [c.key for c in table.columns]
+        self.non_pk_columns = [c for c in table.columns if not c.primary_key]
+
+        # Columns identifying a record across databases: those of all the unique
+        # constraints, or all the non-PK columns if the table has none
+        constraints = [c for c in table.constraints if isinstance(c, UniqueConstraint)]
+        unique_keys = {c.key for constraint in constraints for c in constraint.columns}
+        if unique_keys:
+            self.unique_columns = [c for c in table.columns if c.key in unique_keys]
+        else:
+            self.unique_columns = list(self.non_pk_columns)
+        # Columns of `Base.unique_key`, those of the first unique constraint
+        self.unique_key_keys = (
+            [c.key for c in constraints[0].columns] if constraints else []
+        )
+
+        self.values = tuple_getter(self.keys)
+        self.non_pk_keys = [c.key for c in self.non_pk_columns]
+        self.non_pk_values = tuple_getter(self.non_pk_keys)
+        self.unique_values = tuple_getter([c.key for c in self.unique_columns])
+        self.struct = msgspec.defstruct(
+            model_cls.__name__,
+            [(c.key, Optional[column_python_type(c)]) for c in table.columns],
+            namespace={"__tablename__": table.name},
+            frozen=True,
+            gc=False,
+        )
+
+    def to_dict(self, record):
+        """Values of the loaded columns of a record, without loading the others."""
+        state = record.__dict__
+        return {k: state[k] for k in self.keys if k in state}
+
+    def non_pk_dict(self, record):
+        """Values of the non-PK columns of a record."""
+        return dict(zip(self.non_pk_keys, self.non_pk_values(record)))
+
+    def unique_key(self, record):
+        if not self.unique_key_keys:
+            return None
+        return ", ".join([str(getattr(record, k)) for k in self.unique_key_keys])
+
+    def tuples(self, records):
+        """Column values of records, as tuples in table order."""
+        return [self.values(record) for record in records]
+
+    def dicts(self, records, keys=None):
+        """Values of the columns `keys` (default: all) of records, as dicts."""
+        if keys is None:
+            keys, getter = self.keys, self.values
+        else:
+            getter = tuple_getter(keys)
+        return [dict(zip(keys, getter(record))) for record in records]
+
+    def structs(self, records):
+        """Records as structs of type `self.struct`."""
+        struct = self.struct
+        return [struct(*self.values(record)) for record in records]
+
+
+@lru_cache(maxsize=None)
+def get_serializer(model_cls):
+    return Serializer(model_cls)
 
 
 class Base(DeclarativeBase):
@@ -39,20 +210,14 @@ class Base(DeclarativeBase):
         return f"{self.__class__.__name__}({params})"
 
     def to_dict(self):
-        return to_dict(self)
+        return get_serializer(type(self)).to_dict(self)
 
     def unique_key(self):
-        unique_constraints = [
-            c for c in self.__table__.constraints if isinstance(c, UniqueConstraint)
-        ]
-        if len(unique_constraints) == 0:
-            return None
-        uk_columns = unique_constraints[0].columns
-        return ", ".join([str(getattr(self, c.key)) for c in uk_columns])
+        return get_serializer(type(self)).unique_key(self)
 
     @classmethod
     def non_pk_columns(cls):
-        return [c for c in cls.__table__.columns if not c.primary_key]
+        return list(get_serializer(cls).non_pk_columns)
 
 
 class QuestionSet(Base):
@@ -102,7 +267,10 @@ class Packet(Base):
     packet_questions = relationship("PacketQuestion", back_populates="packet")
     rounds = relationship("Round", back_populates="packet")
 
-    __table_args__ = (UniqueConstraint("name", name="uq_packet_name"),)
+    __table_args__ = (
+        UniqueConstraint("name", name="uq_packet_name"),
+        Index("ix_packet_question_set_edition_id", "question_set_edition_id"),
+    )
 
 
 class PacketQuestion(Base):
@@ -122,6 +290,7 @@ class PacketQuestion(Base):
             "question_id",
             name="uq_packet_question_packet_id_question_number",
         ),
+        Index("ix_packet_question_question_id", "question_id"),
     )
 
 
@@ -143,7 +312,7 @@ class Question(Base):
     category_full = Column(String)
 
     # New column added for consistency. Maybe not be present.
-    # Run `python add_missing_columns.py` to add it to the database.
+    # Run `python migrate.py` to add it to the database.
     question_set_edition_id = Column(
         Integer, ForeignKey("question_set_edition.id"), nullable=True
     )
@@ -163,6 +332,7 @@ class Question(Base):
             "question_set_edition_id",
             name="uq_question_slug_metadata",
         ),
+        Index("ix_question_question_set_edition_id", "question_set_edition_id"),
     )
 
     def has_tossups(self):
@@ -209,7 +379,10 @@ class Tournament(Base):
     rounds = relationship("Round", back_populates="tournament")
     teams = relationship("Team", back_populates="tournament")
 
-    __table_args__ = (UniqueConstraint("slug", name="uq_tournament_slug"),)
+    __table_args__ = (
+        UniqueConstraint("slug", name="uq_tournament_slug"),
+        Index("ix_tournament_question_set_edition_id", "question_set_edition_id"),
+    )
 
 
 class Round(Base):
@@ -225,6 +398,11 @@ class Round(Base):
     packet = relationship("Packet", back_populates="rounds")
     games = relationship("Game", back_populates="round")
 
+    __table_args__ = (
+        Index("ix_round_tournament_id", "tournament_id"),
+        Index("ix_round_packet_id", "packet_id"),
+    )
+
 
 class Team(Base):
     __tablename__ = "team"
@@ -280,6 +458,12 @@ class Game(Base):
     )
     buzzes = relationship("Buzz", back_populates="game")
 
+    __table_args__ = (
+        Index("ix_game_round_id", "round_id"),
+        Index("ix_game_team_one_id", "team_one_id"),
+        Index("ix_game_team_two_id", "team_two_id"),
+    )
+
 
 class Buzz(Base):
     __tablename__ = "buzz"
@@ -303,11 +487,20 @@ class Buzz(Base):
             "buzz_position",
             name="uq_player_game_tossup_buzz_position",
         ),
+        # Covers the buzzes of a tossup without reading the table
+        Index(
+            "ix_buzz_tossup_id",
+            "tossup_id",
+            "player_id",
+            "game_id",
+            "buzz_position",
+            "value",
+        ),
+        Index("ix_buzz_game_id", "game_id"),
     )
 
 
-event.listen(PacketQuestion, "before_insert", validate_packet_question)
-event.listen(PacketQuestion, "before_update", validate_packet_question)
+event.listen(Session, "after_flush", validate_packet_questions)
 
 
 all_classes = [
@@ -326,39 +519,367 @@ all_classes = [
 ]
 
 
-def create_session(db_path, create_tables=False):
-    engine = create_engine(f"sqlite:///{db_path}")
+# Columns that older source dbs lack or leave NULL, with a query deriving their value
+# per source id from other tables of the same db, as (id, value, number of values).
+# Lets merges replace running `add_missing_columns.py` on every source, see
+# `merge_db.derived_column_queries`.
+DERIVED_COLUMNS = {
+    "question": {
+        "question_set_edition_id": """
+            SELECT pq.question_id AS id, MIN(p.question_set_edition_id) AS value,
+                   COUNT(DISTINCT p.question_set_edition_id) AS n_values
+            FROM {schema}.packet_question pq
+            JOIN {schema}.packet p ON p.id = pq.packet_id
+            GROUP BY pq.question_id
+            """,
+    },
+}
+
+
+# Loader options of the common relationship walks, by name. Many-to-one hops are joined
+# into the query and collections are loaded with one `IN` query per batch of parents,
+# so a walk over all the rows costs a fixed number of queries instead of one lazy load
+# per object and hop.
+LOADER_PROFILES = {
+    # buzz.game.round.tournament, buzz.player.team.tournament and buzz.tossup.question
+    "buzz_tournaments": [
+        joinedload(Buzz.game).joinedload(Game.round).joinedload(Round.tournament),
+        joinedload(Buzz.player).joinedload(Player.team).joinedload(Team.tournament),
+        joinedload(Buzz.tossup).joinedload(Tossup.question),
+    ],
+    # tossup.question.question_set_edition.question_set
+    "tossup_question_set": [
+        joinedload(Tossup.question)
+        .joinedload(Question.question_set_edition)
+        .joinedload(QuestionSetEdition.question_set),
+    ],
+    # tossup.buzzes[].game.round.tournament
+    "tossup_buzz_tournaments": [
+        selectinload(Tossup.buzzes)
+        .joinedload(Buzz.game)
+        .joinedload(Game.round)
+        .joinedload(Round.tournament),
+    ],
+    "question_tossups": [selectinload(Question.tossups)],
+    "packet_question_editions": [
+        joinedload(PacketQuestion.question),
+        joinedload(PacketQuestion.packet),
+    ],
+    "round_editions": [joinedload(Round.packet), joinedload(Round.tournament)],
+    "game_teams": [
+        joinedload(Game.round),
+        joinedload(Game.team_one),
+        joinedload(Game.team_two),
+    ],
+    "question_set_edition_tournaments": [
+        joinedload(QuestionSetEdition.question_set),
+        selectinload(QuestionSetEdition.tournaments),
+    ],
+}
+
+
+def loader_options(*profiles):
+    """
+    Loader options of the named `LOADER_PROFILES`, for `query.options(...)`, e.g.
+    `session.query(Buzz).options(*loader_options("buzz_tournaments"))`.
+    """
+    options = []
+    for profile in profiles:
+        if profile not in LOADER_PROFILES:
+            raise ValueError(
+                f"Unknown loader profile {profile!r}, "
+                f"expected one of {list(LOADER_PROFILES)}"
+            )
+        options.extend(LOADER_PROFILES[profile])
+    return options
+
+
+def create_sqlite_engine(db_path, profile="default"):
+    """
+    Create an engine for a SQLite database, with a connection profile of
+    `utils.sqlite_profiles` applied to every new connection.
+    """
+    engine = create_engine(sqlalchemy_url(db_path, profile))
+
+    @event.listens_for(engine, "connect")
+    def set_profile(dbapi_connection, connection_record):
+        apply_profile(dbapi_connection, profile)
+
+    return engine
+
+
+# Process-wide engines and session factories, by (absolute db path, profile)
+_engines = {}
+_session_factories = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(db_path, profile="default"):
+    """
+    Get the shared engine of a database and profile, creating it on first use. Safe to
+    call from several threads; the engines are disposed at exit.
+    """
+    key = (os.path.abspath(db_path), profile)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create_sqlite_engine(db_path, profile)
+            _session_factories[key] = sessionmaker(bind=_engines[key])
+        return _engines[key]
+
+
+def dispose_engines(db_path=None):
+    """
+    Close the pooled connections of the shared engines of a database, or of all
+    databases, and forget them. Needed before deleting or replacing a database file,
+    and to checkpoint the WAL of the "bulk-write" profile.
+    """
+    path = None if db_path is None else os.path.abspath(db_path)
+    with _engines_lock:
+        for key in [key for key in _engines if path is None or key[0] == path]:
+            _engines.pop(key).dispose()
+            del _session_factories[key]
+
+
+atexit.register(dispose_engines)
+
+
+def create_session(db_path, create_tables=False, profile="default"):
+    """
+    Create a session on the shared engine of a database and profile (see `get_engine`).
+    Sessions are not thread-safe, create one per thread.
+    """
+    engine = get_engine(db_path, profile)
     if create_tables:
         # Create tables if they don't exist
         Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
+    with _engines_lock:
+        Session = _session_factories[(os.path.abspath(db_path), profile)]
     return Session()
 
 
-def query_buzzes(session, filters=None, limit=None):
+def create_missing_indexes(conn):
+    """
+    Create the indexes declared by the models that are missing from an existing
+    database, whose tables were created before they were declared.
+
+    FK columns that lead a unique constraint, e.g. `player.team_id` or
+    `tossup.question_id`, are already indexed by it and have no index of their own.
+
+    Indexes on tables or columns that the database does not have yet, e.g.
+    `question.question_set_edition_id` before `migrate.py`, are skipped.
+
+    :return: Names of the created indexes, and of the skipped indexes
+    """
+    existing = {
+        row[0]
+        for row in conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )
+    }
+    created, skipped = [], []
+    for table in Base.metadata.sorted_tables:
+        columns = {
+            row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')
+        }
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+            if not {column.name for column in index.columns} <= columns:
+                skipped.append(index.name)
+                continue
+            index.create(conn)
+            created.append(index.name)
+    return created, skipped
+
+
+def create_transactional_engine(db_path=None, profile="default"):
+    """
+    Create an engine whose transactions also cover DDL and ATTACH statements, so that
+    schema changes can be committed or rolled back with the data. Uses an in-memory
+    database if `db_path` is None.
+    """
+    if db_path is None:
+        engine = create_engine("sqlite://")
+    else:
+        engine = create_sqlite_engine(db_path, profile)
+
+    @event.listens_for(engine, "connect")
+    def disable_implicit_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    return engine
+
+
+# Operators of filters, as "<path>__<operator>" keys; a bare path means "eq", or "in"
+# for a list, tuple or set value
+FILTER_OPERATORS = {
+    "eq": lambda column, value: column.is_(None) if value is None else column == value,
+    "ne": lambda column, value: (
+        column.is_not(None) if value is None else column != value
+    ),
+    "lt": lambda column, value: column < value,
+    "le": lambda column, value: column <= value,
+    "gt": lambda column, value: column > value,
+    "ge": lambda column, value: column >= value,
+    "in": lambda column, value: column.in_(list(value)),
+    "between": lambda column, value: column.between(*value),
+}
+
+
+def resolve_path(model_cls, path, joins):
+    """
+    Resolve a column path such as "value" or "game.round.tournament.end_date" from a
+    model, through its many-to-one relationships.
+
+    :param joins: {relationship path: (parent entity, relationship key, alias)} of the
+        joins needed so far, updated with the joins of `path`
+    :return: The column attribute, on the alias of its table
+    """
+    *hops, column_key = path.split(".")
+    entity, mapper = model_cls, model_cls.__mapper__
+    for i, hop in enumerate(hops):
+        relationship = mapper.relationships.get(hop)
+        if relationship is None or relationship.uselist:
+            raise ValueError(
+                f"{mapper.class_.__name__}.{hop} is not a many-to-one relationship "
+                f"in {path!r}"
+            )
+        key = tuple(hops[: i + 1])
+        if key not in joins:
+            joins[key] = (entity, hop, aliased(relationship.mapper.class_))
+        entity, mapper = joins[key][2], relationship.mapper
+    if column_key not in mapper.columns:
+        raise ValueError(f"{mapper.class_.__name__} has no column {column_key!r}")
+    return getattr(entity, column_key)
+
+
+def filter_condition(model_cls, key, value, joins):
+    """Condition of a filter of `query_records`."""
+    path, _, op = key.rpartition("__")
+    if op not in FILTER_OPERATORS:
+        path, op = key, "in" if isinstance(value, (list, tuple, set)) else "eq"
+    return FILTER_OPERATORS[op](resolve_path(model_cls, path, joins), value)
+
+
+def keyset_condition(columns, descending, values):
+    """
+    Condition selecting the rows that come after `values` in the order of `columns`.
+    NULLs come first in ascending order and last in descending order, as in SQLite.
+    """
+    condition = false()
+    # From the last column to the first: after on this column, or equal and after on
+    # the next ones
+    for column, desc, value in reversed(list(zip(columns, descending, values))):
+        if value is None:
+            after = false() if desc else column.is_not(None)
+            equal = column.is_(None)
+        else:
+            after = or_(column < value, column.is_(None)) if desc else column > value
+            equal = column == value
+        condition = or_(after, and_(equal, condition))
+    return condition
+
+
+def query_records(
+    session,
+    model_cls,
+    filters=None,
+    order_by=("id",),
+    limit=None,
+    batch_size=1000,
+    loaders=(),
+    expunge=False,
+):
+    """
+    Stream the records of a model in order, fetched `batch_size` at a time with
+    keyset pagination: each batch starts after the ordering values of the last record
+    of the previous one, so deep pages cost no more than the first one, unlike OFFSET.
+
+    Filters and ordering columns are column paths, optionally through many-to-one
+    relationships, which are outer joined, e.g.
+
+        query_records(
+            session,
+            Buzz,
+            {
+                "game.round.tournament.end_date__ge": date(2024, 1, 1),
+                "tossup.question.category_slug": ["history", "science"],
+            },
+            order_by=["-value"],
+        )
+
+    Only an order served by an index, such as the default id order, makes every batch
+    cheap; otherwise each batch sorts the remaining matching rows.
+
+    :param filters: {path or "<path>__<operator>": value}, see `FILTER_OPERATORS`
+    :param order_by: Paths to order by, prefixed with "-" for descending order. The id
+        of the model is always added last, to make the order unique.
+    :param limit: Maximum number of records
+    :param loaders: Names of `LOADER_PROFILES` to eager-load
+    :param expunge: Expunge the records of each batch from the session before fetching
+        the next one, to bound memory use. Expunged records cannot lazy load.
+    :return: Generator of records
+    """
+    joins = {}
+    conditions = [
+        filter_condition(model_cls, key, value, joins)
+        for key, value in (filters or {}).items()
+    ]
+    paths = [path.lstrip("-") for path in order_by]
+    descending = [path.startswith("-") for path in order_by]
+    if "id" not in paths:
+        paths.append("id")
+        descending.append(False)
+    columns = [resolve_path(model_cls, path, joins) for path in paths]
+
+    stmt = select(model_cls, *columns)
+    for parent, hop, alias in joins.values():
+        stmt = stmt.outerjoin(getattr(parent, hop).of_type(alias))
+    stmt = (
+        stmt.where(*conditions)
+        .order_by(*[c.desc() if d else c.asc() for c, d in zip(columns, descending)])
+        .options(*loader_options(*loaders))
+    )
+
+    last_values, n_records = None, 0
+    while limit is None or n_records < limit:
+        page = stmt
+        if last_values is not None:
+            page = page.where(keyset_condition(columns, descending, last_values))
+        n_rows = batch_size if limit is None else min(batch_size, limit - n_records)
+        rows = session.execute(page.limit(n_rows)).all()
+        for row in rows:
+            yield row[0]
+        n_records += len(rows)
+        if len(rows) < n_rows:
+            break
+        last_values = tuple(rows[-1][1:])
+        if expunge:
+            for row in rows:
+                session.expunge(row[0])
+
+
+def query_buzzes(session, filters=None, limit=None, loaders=()):
     """
     Query buzzes from the database with optional filters.
 
     :param session: SQLAlchemy session
-    :param filters: Dictionary of filters to apply to the query
+    :param filters: Dictionary of filters to apply to the query, see `query_records`
     :param limit: Maximum number of results to return
+    :param loaders: Names of `LOADER_PROFILES` to eager-load
     :return: List of Buzz objects
     """
-    query = session.query(Buzz)
-
-    if filters:
-        for key, value in filters.items():
-            if hasattr(Buzz, key):
-                query = query.filter(getattr(Buzz, key) == value)
-
-    if limit:
-        query = query.limit(limit)
-
-    return query.all()
+    return list(
+        query_records(session, Buzz, filters, limit=limit or None, loaders=loaders)
+    )
 
 
 if __name__ == "__main__":
-    session = create_session("data/sst-23-24-cleaned.db")
+    session = create_session("data/sst-23-24-cleaned.db", profile="analytics")
 
     # Query buzzes
     filters = {"player_id": 1, "value": 10}
@@ -17,11 +17,12 @@ from utils.acf_sanitization import (
     tokenize,
 )
 from utils.qb_tokenization import get_clue_spans
+from utils.query_cache import QueryCache
 from utils.sqlite_client import DBClient
 
 # %%
-session = models.create_session("./data/acf-23-24.db")
-db = DBClient("./data/acf-23-24.db")
+session = models.create_session("./data/acf-23-24.db", profile="analytics")
+db = DBClient("./data/acf-23-24.db", profile="analytics", cache=QueryCache())
 # %%
 
 
@@ -242,7 +243,7 @@ else:
 
 # %%
 
-db2 = DBClient("./data/nats24.db")
+db2 = DBClient("./data/nats24.db", profile="analytics", cache=QueryCache())
 players_df2 = db2.get_player_info()
 tossup_df2 = db2.get_tossups_info()
 game_df2 = db2.get_game_info()
@@ -257,8 +258,8 @@ set(players_df2["slug"]).intersection(set(players_df["slug"]))
 
 # %%
 
-session1 = models.create_session("./data/acf-23-24.db")
-session2 = models.create_session("./data/sst-23-24-cleaned.db")
+session1 = models.create_session("./data/acf-23-24.db", profile="analytics")
+session2 = models.create_session("./data/sst-23-24-cleaned.db", profile="analytics")
 # %%
 # List all buzzes from acf24 such that the player slug is X
 acf_buzzes = (
@@ -0,0 +1,162 @@
+"""
+Read-only snapshots of a database, loaded without the ORM.
+
+The rows of the models of `models.all_classes` are read with plain SQL and kept as
+frozen msgspec structs, of the struct type of `models.get_serializer` with the columns
+of the model as fields, or as NumPy record arrays. There is no session, identity map or
+lazy loading: related rows are looked up by id through the snapshot instead, e.g.
+`snapshot.parent(buzz, "game")` or `snapshot.children(tossup, "buzzes")`.
+
+Tables are loaded on first use. Columns missing from an older database are None, or
+`MISSING` in the integer columns of record arrays.
+
+Example usage:
+    snapshot = Snapshot("data/sst-23-24-cleaned.db")
+    for buzz in snapshot.rows(models.Buzz).values():
+        round = snapshot.parent(snapshot.parent(buzz, "game"), "round")
+        tournament = snapshot.parent(round, "tournament")
+"""
+
+import datetime
+from typing import Dict, List, Optional, Type
+
+import msgspec
+import numpy as np
+from sqlalchemy import Boolean, Integer
+from sqlalchemy.orm import RelationshipDirection
+
+import models
+from models import Base, column_python_type, get_serializer
+from utils.sqlite_profiles import connect
+
+# Value of NULL and missing integer columns in record arrays
+MISSING = -1
+
+
+def column_dtype(column) -> np.dtype:
+    if isinstance(column.type, Boolean):
+        return np.dtype(np.int8)
+    if isinstance(column.type, Integer):
+        return np.dtype(np.int64)
+    return np.dtype(object)
+
+
+class Snapshot:
+    """
+    Lazily loaded, read-only snapshot of the tables of a database.
+
+    :param profile: Connection profile of `utils.sqlite_profiles`
+    """
+
+    def __init__(self, db_path: str, profile: str = "analytics"):
+        self.path = db_path
+        self.con = connect(db_path, profile)
+        self._rows = {}
+        self._records = {}
+        self._children = {}
+        self._models = {cls.__tablename__: cls for cls in models.all_classes}
+
+    def close(self) -> None:
+        self.con.close()
+
+    def _select(self, model_cls: Type[Base], fill_missing: bool = False) -> List[tuple]:
+        """
+        Rows of a table in id order, with NULL for the columns it lacks, or `MISSING`
+        for the NULL values of Integer and Boolean columns if `fill_missing` is set.
+        """
+        table = model_cls.__table__
+        existing = {
+            row[1] for row in self.con.execute(f'PRAGMA table_info("{table.name}")')
+        }
+        columns = []
+        for column in table.columns:
+            value = f'"{column.name}"' if column.name in existing else "NULL"
+            if fill_missing and column_dtype(column) != object:
+                value = f"COALESCE({value}, {MISSING})"
+            columns.append(value)
+        return self.con.execute(
+            f'SELECT {", ".join(columns)} FROM "{table.name}" ORDER BY id'
+        ).fetchall()
+
+    def rows(self, model_cls: Type[Base]) -> Dict[int, msgspec.Struct]:
+        """{id: struct} of all the rows of a model."""
+        if model_cls not in self._rows:
+            struct = get_serializer(model_cls).struct
+            convert = [
+                i
+                for i, column in enumerate(model_cls.__table__.columns)
+                if column_python_type(column) in (bool, datetime.date)
+            ]
+            rows = self._select(model_cls)
+            if convert:
+                rows = [self._convert(row, convert, model_cls) for row in rows]
+            self._rows[model_cls] = {row[0]: struct(*row) for row in rows}
+        return self._rows[model_cls]
+
+    @staticmethod
+    def _convert(row: tuple, indexes: List[int], model_cls: Type[Base]) -> tuple:
+        """Convert the SQLite values of Boolean and Date columns of a row."""
+        row = list(row)
+        columns = model_cls.__table__.columns
+        for i in indexes:
+            if row[i] is None:
+                continue
+            if column_python_type(columns[i]) is bool:
+                row[i] = bool(row[i])
+            else:
+                row[i] = datetime.date.fromisoformat(row[i])
+        return row
+
+    def get(self, model_cls: Type[Base], id: Optional[int]):
+        """Struct of a row by id, or None."""
+        return self.rows(model_cls).get(id)
+
+    def records(self, model_cls: Type[Base]) -> np.recarray:
+        """
+        All the rows of a model as a record array sorted by id, with the columns of
+        the model as fields. Integer and Boolean columns are int64 and int8, with
+        `MISSING` for NULL; other columns hold the SQLite values, e.g. dates as
+        ISO strings.
+        """
+        if model_cls not in self._records:
+            dtype = [(c.key, column_dtype(c)) for c in model_cls.__table__.columns]
+            self._records[model_cls] = np.rec.array(
+                np.array(self._select(model_cls, fill_missing=True), dtype=dtype)
+            )
+        return self._records[model_cls]
+
+    def positions(self, model_cls: Type[Base], ids) -> np.ndarray:
+        """Positions of ids in `records(model_cls)`, -1 for unknown ids."""
+        record_ids = self.records(model_cls).id
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(record_ids, ids)
+        positions[positions == len(record_ids)] = 0
+        found = len(record_ids) > 0 and record_ids[positions] == ids
+        return np.where(found, positions, -1)
+
+    def _relationship(self, obj: msgspec.Struct, name: str):
+        model_cls = self._models[obj.__tablename__]
+        relationship = model_cls.__mapper__.relationships[name]
+        local, remote = next(iter(relationship.local_remote_pairs))
+        return relationship, local, remote
+
+    def parent(self, obj: msgspec.Struct, name: str):
+        """Struct of the many-to-one relationship `name` of a struct, or None."""
+        relationship, local, _ = self._relationship(obj, name)
+        if relationship.direction != RelationshipDirection.MANYTOONE:
+            raise ValueError(f"{name} is not a many-to-one relationship")
+        return self.get(relationship.mapper.class_, getattr(obj, local.key))
+
+    def children(self, obj: msgspec.Struct, name: str) -> List[msgspec.Struct]:
+        """Structs of the one-to-many relationship `name` of a struct, by id."""
+        relationship, _, remote = self._relationship(obj, name)
+        if relationship.direction != RelationshipDirection.ONETOMANY:
+            raise ValueError(f"{name} is not a one-to-many relationship")
+        key = (obj.__tablename__, name)
+        if key not in self._children:
+            # Index of {parent id: children} of the relationship, built once
+            index = {}
+            for child in self.rows(relationship.mapper.class_).values():
+                index.setdefault(getattr(child, remote.key), []).append(child)
+            self._children[key] = index
+        return self._children[key].get(obj.id, [])
@@ -28,6 +28,15 @@ class QuizbowlQuestion(msgspec.Struct):
         return clues
 
 
+def query_tossups(session) -> list[models.Tossup]:
+    """All the tossups, with the relationships read by `create_tossup_entry` loaded."""
+    return (
+        session.query(models.Tossup)
+        .options(*models.loader_options("tossup_question_set"))
+        .all()
+    )
+
+
 def create_tossup_entry(tossup: models.Tossup):
     question_sanitized = acf_sanitization.sanitize_question(tossup.question_text)
     clue_spans = qb_tokenization.get_clue_spans(
@@ -0,0 +1,123 @@
+"""
+Persistent on-disk cache of query results, used by `DBClient`.
+
+Results are pandas DataFrames stored as Parquet files, keyed by the identity of the
+database file, the SQL text and a version of the post-processing of the result. The
+identity of a database is its path, size and modification time, and those of its WAL
+file, or the SHA-256 of their contents with `identity="content"`, which also survives
+copies and `touch` at the cost of reading the files. Any change to the database thus
+misses the cache, and stale entries are evicted, least recently used first, once the
+cache grows beyond `max_bytes`.
+"""
+
+import hashlib
+import os
+import tempfile
+from typing import Callable, Optional
+
+import pandas as pd
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "queries")
+
+
+def file_identity(path: str, identity: str = "stat") -> str:
+    """Identity of a database file, along with its WAL file if any."""
+    parts = []
+    for file_path in [path, f"{path}-wal"]:
+        if not os.path.exists(file_path):
+            continue
+        if identity == "content":
+            digest = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+            parts.append(digest.hexdigest())
+        elif identity == "stat":
+            stat = os.stat(file_path)
+            parts.append(
+                f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+            )
+        else:
+            raise ValueError(f"Unknown identity {identity!r}, expected stat or content")
+    return "|".join(parts)
+
+
+class QueryCache:
+    """
+    Directory of cached query results, evicted LRU beyond `max_bytes`.
+
+    :param identity: "stat" or "content", see `file_identity`
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_bytes: int = 2 << 30,
+        identity: str = "stat",
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.identity = identity
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, db_path: str, sql: str, version: str) -> str:
+        digest = hashlib.sha256()
+        for part in [file_identity(db_path, self.identity), sql, version]:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        path = self._path(key)
+        try:
+            df = pd.read_parquet(path)
+        except FileNotFoundError:
+            return None
+        # The modification time of an entry is the time it was last used
+        os.utime(path)
+        return df
+
+    def put(self, key: str, df: pd.DataFrame) -> None:
+        # Written to a temporary file first, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, self._path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits `max_bytes`."""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".parquet"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Evicted by another process
+                pass
+            total -= size
+
+    def cached(
+        self, db_path: str, sql: str, version: str, compute: Callable[[], pd.DataFrame]
+    ) -> pd.DataFrame:
+        """Result of `compute` for a database and query, from the cache if present."""
+        key = self.key(db_path, sql, version)
+        df = self.get(key)
+        if df is None:
+            df = compute()
+            self.put(key, df)
+        return df
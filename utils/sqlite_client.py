@@ -1,11 +1,22 @@
 # %%
-import sqlite3 as sq
 from collections import defaultdict
+from typing import Optional
 
 import pandas as pd
 from tabulate import tabulate
 
 import queries
+from utils.query_cache import QueryCache
+from utils.sqlite_profiles import connect
+
+# Versions of the post-processing of the cached query helpers of `DBClient`. Bump the
+# version of a helper when changing what it does with the result of its query.
+CACHE_VERSIONS = {
+    "get_tossups_info": 1,
+    "get_game_info": 1,
+    "get_player_info": 1,
+    "get_buzzpoints_info": 1,
+}
 
 
 def print_table(df: pd.DataFrame):
@@ -13,9 +24,20 @@ def print_table(df: pd.DataFrame):
 
 
 class DBClient:
-    def __init__(self, db_path: str):
+    def __init__(
+        self,
+        db_path: str,
+        profile: str = "default",
+        cache: Optional[QueryCache] = None,
+    ):
+        """
+        :param profile: Connection profile of `utils.sqlite_profiles`, e.g. "analytics"
+        :param cache: Cache of the results of the `get_*_info` helpers, which then skip
+            SQLite while the database is unchanged
+        """
         self.path = db_path
-        self.con = sq.connect(db_path)
+        self.con = connect(db_path, profile)
+        self.cache = cache
 
     def Q(self, q: str):
         return pd.read_sql(q, self.con)
@@ -47,16 +69,41 @@ class DBClient:
     def table_head(self, table_name: str, n_rows: int = 10):
         return self.Q(f"SELECT * FROM {table_name} LIMIT {n_rows};")
 
+    def _cached(self, name: str, sql: str, compute) -> pd.DataFrame:
+        if self.cache is None:
+            return compute()
+        version = f"{name}:{CACHE_VERSIONS[name]}"
+        return self.cache.cached(self.path, sql, version, compute)
+
     def get_tossups_info(self):
-        return self.Q(queries.TOSSUP_INFO_QUERY).set_index("id")
+        return self._cached(
+            "get_tossups_info",
+            queries.TOSSUP_INFO_QUERY,
+            lambda: self.Q(queries.TOSSUP_INFO_QUERY).set_index("id"),
+        )
 
     def get_game_info(self):
-        return self.Q(queries.GAME_INFO_QUERY).set_index("id")
+        return self._cached(
+            "get_game_info",
+            queries.GAME_INFO_QUERY,
+            lambda: self.Q(queries.GAME_INFO_QUERY).set_index("id"),
+        )
 
     def get_player_info(self):
-        return self.Q(queries.PLAYER_INFO_QUERY).set_index("id")
+        return self._cached(
+            "get_player_info",
+            queries.PLAYER_INFO_QUERY,
+            lambda: self.Q(queries.PLAYER_INFO_QUERY).set_index("id"),
+        )
 
     def get_buzzpoints_info(self):
+        return self._cached(
+            "get_buzzpoints_info",
+            queries.BUZZPOINTS_INFO_QUERY,
+            self._get_buzzpoints_info,
+        )
+
+    def _get_buzzpoints_info(self):
         df = (
             self.Q(queries.BUZZPOINTS_INFO_QUERY)
             .set_index("id")
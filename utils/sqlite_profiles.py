@@ -0,0 +1,95 @@
+"""
+Named SQLite connection profiles, shared by `models.create_session` and `DBClient`.
+
+A profile sets URI parameters used to open the database file and PRAGMAs run on every
+new connection:
+- "default": SQLite defaults.
+- "bulk-write": for merges and migrations. WAL journal, no fsync, a 1 GiB page cache
+  and in-memory temp tables. A crash of the process is safe, but a power loss may
+  corrupt the database. The WAL journal mode is stored in the database file, so writers
+  switch it back with `reset_journal_mode` once done.
+- "read-only": opens the database with `mode=ro` and memory-maps it.
+- "analytics": "read-only" with `immutable=1`, which also skips file locking. Only for
+  databases that no process is writing to, e.g. finished merges.
+"""
+
+import sqlite3
+from typing import Dict, NamedTuple
+from urllib.parse import quote
+
+
+class SQLiteProfile(NamedTuple):
+    uri_params: Dict[str, str]
+    pragmas: Dict[str, str]
+
+
+_READ_PRAGMAS = {"mmap_size": str(1 << 30), "cache_size": "-262144"}
+
+PROFILES = {
+    "default": SQLiteProfile({}, {}),
+    "bulk-write": SQLiteProfile(
+        {},
+        {
+            "journal_mode": "WAL",
+            "synchronous": "OFF",
+            "cache_size": "-1048576",
+            "temp_store": "MEMORY",
+        },
+    ),
+    "read-only": SQLiteProfile({"mode": "ro"}, _READ_PRAGMAS),
+    "analytics": SQLiteProfile({"mode": "ro", "immutable": "1"}, _READ_PRAGMAS),
+}
+
+# Profiles that can write to the database
+WRITE_PROFILES = [
+    name for name, profile in PROFILES.items() if "mode" not in profile.uri_params
+]
+
+
+def get_profile(profile: str) -> SQLiteProfile:
+    if profile not in PROFILES:
+        raise ValueError(
+            f"Unknown SQLite profile {profile!r}, expected one of {list(PROFILES)}"
+        )
+    return PROFILES[profile]
+
+
+def sqlite_uri(db_path: str, profile: str = "default") -> str:
+    """`file:` URI opening `db_path` with the URI parameters of a profile."""
+    params = "&".join(f"{k}={v}" for k, v in get_profile(profile).uri_params.items())
+    return f"file:{quote(db_path)}" + (f"?{params}" if params else "")
+
+
+def sqlalchemy_url(db_path: str, profile: str = "default") -> str:
+    """SQLAlchemy URL opening `db_path` with the URI parameters of a profile."""
+    if not get_profile(profile).uri_params:
+        return f"sqlite:///{db_path}"
+    return f"sqlite:///{sqlite_uri(db_path, profile)}&uri=true"
+
+
+def apply_profile(dbapi_connection, profile: str = "default") -> None:
+    """Run the PRAGMAs of a profile on a new DB-API connection."""
+    cursor = dbapi_connection.cursor()
+    for name, value in get_profile(profile).pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def connect(db_path: str, profile: str = "default", **kwargs) -> sqlite3.Connection:
+    """`sqlite3.connect` with a profile; `kwargs` are passed on to `sqlite3.connect`."""
+    con = sqlite3.connect(sqlite_uri(db_path, profile), uri=True, **kwargs)
+    apply_profile(con, profile)
+    return con
+
+
+def reset_journal_mode(db_path: str, profile: str = "default") -> None:
+    """
+    Switch a database written with a WAL profile back to the default rollback journal,
+    which checkpoints and removes its WAL file. Needs all other connections to the
+    database to be closed.
+    """
+    if get_profile(profile).pragmas.get("journal_mode", "").upper() != "WAL":
+        return
+    con = sqlite3.connect(db_path)
+    con.execute("PRAGMA journal_mode = DELETE")
+    con.close()